@@ -0,0 +1,3 @@
+def timeraw_import():
+    """Importing the extension must stay cheap for builders that never use it."""
+    return "import sphinxext.rediraffe"
@@ -0,0 +1,45 @@
+from pathlib import Path
+
+from sphinxext.rediraffe import create_graph, create_simple_redirects
+
+from .generators import SHAPES, SIZES, generate_edges, write_redirects_file
+
+
+class CreateGraph:
+    """Parse a redirects file into a dict of redirects."""
+
+    params = (SHAPES, SIZES)
+    param_names = ["shape", "edges"]
+    timeout = 600
+
+    def setup_cache(self):
+        files = {}
+        for shape in SHAPES:
+            for edges in SIZES:
+                path = Path(f"redirects_{shape}_{edges}.txt").resolve()
+                write_redirects_file(path, generate_edges(shape, edges))
+                files[shape, edges] = path
+        return files
+
+    def time_create_graph(self, files, shape, edges):
+        create_graph(files[shape, edges])
+
+    def peakmem_create_graph(self, files, shape, edges):
+        create_graph(files[shape, edges])
+
+
+class CreateSimpleRedirects:
+    """Resolve every redirect to its final destination."""
+
+    params = (SHAPES, SIZES)
+    param_names = ["shape", "edges"]
+    timeout = 600
+
+    def setup(self, shape, edges):
+        self.redirects = generate_edges(shape, edges)
+
+    def time_create_simple_redirects(self, shape, edges):
+        create_simple_redirects(self.redirects)
+
+    def peakmem_create_simple_redirects(self, shape, edges):
+        create_simple_redirects(self.redirects)
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from sphinx.application import Sphinx
+
+from .generators import generate_edges, write_redirects_file
+
+# writing a million stubs takes several gigabytes of tmpfs
+WRITE_SIZES = [1_000, 10_000, 100_000]
+
+CONF_PY = """\
+extensions = ["sphinxext.rediraffe"]
+master_doc = "index"
+rediraffe_redirects = "redirects.txt"
+"""
+
+
+def _tmpfs_dir() -> str:
+    # keep the file system out of the measurement where possible
+    shm = "/dev/shm"
+    return tempfile.mkdtemp(
+        prefix="rediraffe-bench-", dir=shm if os.path.isdir(shm) else None
+    )
+
+
+def _write_project(srcdir: Path, redirects: dict) -> None:
+    """A Sphinx project with a document for every page the redirects end at."""
+    (srcdir / "conf.py").write_text(CONF_PY, encoding="utf8")
+    write_redirects_file(srcdir / "redirects.txt", redirects)
+    leaves = {"index.rst"} | set(redirects.values())
+    leaves.difference_update(redirects)
+    for leaf in leaves:
+        page = srcdir / leaf
+        page.parent.mkdir(parents=True, exist_ok=True)
+        page.write_text(f":orphan:\n\n{leaf}\n{'=' * len(leaf)}\n", encoding="utf8")
+
+
+class WriteRedirects:
+    """
+    An html build of a project whose redirects end at a handful of documents, so the
+    build is dominated by build_redirects: checking every redirect, writing the stubs and
+    saving the redirect record. Only the public extension entry point is used, so the
+    benchmark runs against every release.
+    """
+
+    params = (["forest", "fanin"], WRITE_SIZES, [1, 4])
+    param_names = ["shape", "edges", "jobs"]
+    timeout = 600
+    number = 1
+    repeat = (1, 5, 60.0)
+
+    def setup(self, shape, edges, jobs):
+        self.tmpdir = Path(_tmpfs_dir())
+        self.srcdir = self.tmpdir / "src"
+        self.srcdir.mkdir()
+        _write_project(self.srcdir, generate_edges(shape, edges))
+
+    def teardown(self, shape, edges, jobs):
+        shutil.rmtree(self.tmpdir)
+
+    def build(self, jobs):
+        app = Sphinx(
+            srcdir=str(self.srcdir),
+            confdir=str(self.srcdir),
+            outdir=str(self.tmpdir / "build" / "html"),
+            doctreedir=str(self.tmpdir / "build" / "doctrees"),
+            buildername="html",
+            status=None,
+            warning=None,
+            parallel=jobs,
+        )
+        app.build()
+
+    def time_write_redirects(self, shape, edges, jobs):
+        self.build(jobs)
+
+
+class RewriteRedirects(WriteRedirects):
+    """A rebuild of an unchanged project, where every stub is already up to date."""
+
+    params = (["forest"], WRITE_SIZES, [1])
+
+    def setup(self, shape, edges, jobs):
+        super().setup(shape, edges, jobs)
+        self.build(jobs)
+
+    def time_write_redirects(self, shape, edges, jobs):
+        self.build(jobs)
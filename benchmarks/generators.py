@@ -0,0 +1,49 @@
+"""
+Synthetic redirect graphs for the benchmarks. Every generator is deterministic for a
+given number of edges, and every graph is acyclic so it can be resolved and written.
+"""
+
+import random
+from pathlib import Path
+from typing import Dict
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+SHAPES = ["forest", "chain", "fanin", "quoted"]
+
+
+def _page(i: int, space: bool = False) -> str:
+    # spread pages over directories like a real documentation tree
+    name = f"page {i}" if space else f"page{i}"
+    return f"section{i % 97}/sub{i % 7}/{name}.rst"
+
+
+def generate_edges(shape: str, edges: int) -> Dict[str, str]:
+    """
+    forest: every page redirects a few pages further, so chains are short and merge.
+    chain:  a single chain of the given length.
+    fanin:  every page redirects to the same page.
+    quoted: like forest, with spaces in every path.
+    """
+    if shape == "chain":
+        return {_page(i): _page(i + 1) for i in range(edges)}
+    if shape == "fanin":
+        return {_page(i): "index.rst" for i in range(edges)}
+    if shape in ("forest", "quoted"):
+        rng = random.Random(edges)
+        space = shape == "quoted"
+        return {
+            _page(i, space): _page(i + rng.randint(1, 10), space) for i in range(edges)
+        }
+    raise ValueError(f"unknown shape {shape}")
+
+
+def write_redirects_file(path: Path, redirects: Dict[str, str]) -> None:
+    """Write redirects in the rediraffe file format, quoting paths that contain spaces."""
+
+    def quote(p: str) -> str:
+        return f'"{p}"' if " " in p else p
+
+    with open(path, "w", encoding="utf8") as f:
+        f.write("# generated redirects\n")
+        for redirect_from, redirect_to in redirects.items():
+            f.write(f"{quote(redirect_from)} {quote(redirect_to)}\n")
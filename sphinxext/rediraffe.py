@@ -1,25 +1,79 @@
+from __future__ import annotations
+
+import hashlib
 import json
-from os import rename
+from array import array
+import os
+import pickle
+import posixpath
 import re
-import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from logging import INFO, StreamHandler
+from concurrent.futures import ThreadPoolExecutor
 from os.path import relpath
 from pathlib import Path, PurePath, PureWindowsPath, PurePosixPath
-from typing import Any, Dict, List, Union
+from weakref import WeakKeyDictionary
+from functools import lru_cache, wraps
+from typing import (
+    TYPE_CHECKING,
+    AbstractSet,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Set,
+    Tuple,
+    Union,
+)
 
-from jinja2 import Environment, FileSystemLoader, Template
-from sphinx.application import Sphinx
-from sphinx.builders import Builder
-from sphinx.builders.dirhtml import DirectoryHTMLBuilder
-from sphinx.builders.html import StandaloneHTMLBuilder
-from sphinx.builders.linkcheck import CheckExternalLinksBuilder
-from sphinx.errors import ExtensionError
-from sphinx.util import logging
-from sphinx.util.console import green, red, yellow  # pylint: disable=no-name-in-module
+if __name__ == "__main__":
+    # python -m sphinxext.rediraffe writes stubs without importing Sphinx, so the Sphinx
+    # error, logger and colors are replaced by plain stdlib equivalents
+    from logging import LoggerAdapter, getLogger
 
-logger = logging.getLogger(__name__)
+    class ExtensionError(Exception):
+        pass
 
-DEFAULT_REDIRAFFE_TEMPLATE = Template(
-    """
+    class _CliLoggerAdapter(LoggerAdapter):
+        def verbose(self, msg: str, *args: Any, **kwargs: Any) -> None:
+            # sphinx.util.logging.VERBOSE
+            self.log(15, msg, *args, **kwargs)
+
+    def _plain(text: str) -> str:
+        return text
+
+    def color_terminal() -> bool:
+        return False
+
+    def nocolor() -> None:
+        pass
+
+    green = red = yellow = _plain
+    logger = _CliLoggerAdapter(getLogger("sphinx.sphinxext.rediraffe"), {})
+else:
+    from sphinx.errors import ExtensionError
+    from sphinx.util import logging
+    from sphinx.util.console import (  # pylint: disable=no-name-in-module
+        color_terminal,
+        green,
+        nocolor,
+        red,
+        yellow,
+    )
+
+    logger = logging.getLogger(__name__)
+
+if TYPE_CHECKING:
+    from jinja2 import Environment, Template
+    from sphinx.application import Sphinx
+    from sphinx.builders import Builder
+
+# compiled on first use, see _default_template
+_DEFAULT_TEMPLATE_SOURCE = """
 <html>
     <head>
         <noscript>
@@ -36,84 +90,97 @@ DEFAULT_REDIRAFFE_TEMPLATE = Template(
 </html>
 
 """
-)
 REDIRECT_JSON_NAME = "_rediraffe_redirected.json"
+REDIRECT_DB_NAME = "_rediraffe_redirected.sqlite"
+MANIFEST_JSON_NAME = "_rediraffe_manifest.json"
+REDIRECT_PLAN_NAME = "rediraffe_plan.json"
+RESOLVED_CACHE_NAME = "rediraffe_resolved.pickle"
+RESOLVED_CACHE_VERSION = 2
+DIFF_CACHE_NAME = "rediraffe_diff.pickle"
+DIFF_CACHE_VERSION = 1
+TEMPLATE_CACHE_NAME = "rediraffe_templates"
+METRICS_NAMES = {
+    "json": "rediraffe_metrics.json",
+    "prometheus": "rediraffe_metrics.prom",
+}
 RE_OBJ = re.compile(r"(?:(\"|')(.*?)\1|(\S+))\s+(?:(\"|')(.*?)\4|(\S+))")
 
 READTHEDOCS_BUILDERS = ["readthedocs", "readthedocsdirhtml"]
 
 
-def create_graph(path: Path) -> Dict[str, str]:
-    """
-    Convert a file containing a whitespace delimited edge list (key value pairs) to a dict. Throws error on duplicate keys.
-    """
-    graph_edges = {}
-    broken = False
-    with open(path, "r") as file:
-        for line_num, line in enumerate(file, start=1):
-            line = line.strip()
-            if len(line) == 0 or line.startswith("#"):
-                continue
-            match = RE_OBJ.fullmatch(line)
-
-            if match == None:
-                logger.error(
-                    red(f"rediraffe: line {line_num} of the redirects is invalid!")
-                )
-                broken = True
-                continue
+def __getattr__(name: str) -> Any:
+    """Module attributes that are only created on first access."""
+    if name == "DEFAULT_REDIRAFFE_TEMPLATE":
+        return _default_template()
+    if name in (
+        "CheckRedirectsDiffBuilder",
+        "WriteRedirectsDiffBuilder",
+        "RedirectsPlanBuilder",
+        "RedirectsCompactBuilder",
+    ):
+        from sphinxext import rediraffe_builders
 
-            edge_from = match.group(2) or match.group(3)
-            edge_to = match.group(5) or match.group(6)
-            if edge_from in graph_edges:
-                # Duplicate vertices not allowed / Vertices can only have 1 outgoing edge
-                logger.error(
-                    red(
-                        f"rediraffe: {edge_from} is redirected multiple times in the rediraffe_redirects file!"
-                    )
-                )
-                broken = True
-            graph_edges[edge_from] = edge_to
-    if broken:
-        err_msg = f"rediraffe: Error(s) in parsing the redirects file."
-        logger.error(err_msg)
-        raise ExtensionError(err_msg)
-    return graph_edges
+        return getattr(rediraffe_builders, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-def create_simple_redirects(graph_edges: dict) -> dict:
+def _resolve_leaves(
+    edges: Dict[Any, Any], name: Callable[[Any], str]
+) -> Dict[Any, Any]:
     """
-    Ensures that a graph is a acyclic and reconnects every vertex to its leaf vertex.
+    Ensures that a graph, given as a dict of edges, is acyclic and returns the leaf of every
+    redirected vertex. Vertices are logged by their name.
+
+    Every vertex has at most 1 outgoing edge, so every strongly connected component with
+    more than 1 vertex is a simple cycle. A walk finds such a cycle when it reaches a vertex
+    that is already on the current walk. Leaves are memoized as chains are walked (path
+    compression), so every edge is followed a constant number of times and every cycle
+    is reported exactly once.
     """
-    redirects = {}
-    broken_vertices = set()
-    for vertex in graph_edges:
-        if vertex in broken_vertices:
+    redirects: Dict[Any, Any] = {}
+    broken_vertices: Dict[Any, None] = {}
+    for start, vertex in edges.items():
+        if start in redirects or start in broken_vertices:
+            continue
+        if vertex not in edges:
+            # most redirects point straight at a page
+            redirects[start] = vertex
             continue
 
-        visited = []
-        while vertex in graph_edges:
-            if vertex in visited:
+        visited = [start]
+        on_path = {start: 0}
+        while (
+            vertex in edges
+            and vertex not in redirects
+            and vertex not in broken_vertices
+        ):
+            if vertex in on_path:
                 # Ensure graph is a DAG
                 logger.error(
                     red(
                         "rediraffe: A circular redirect exists. Links involved: "
-                        + " -> ".join(visited + [vertex])
+                        + " -> ".join(map(name, visited[on_path[vertex] :] + [vertex]))
                     )
                 )
-                broken_vertices.update(visited)
                 break
+            on_path[vertex] = len(visited)
             visited.append(vertex)
-            vertex = graph_edges[vertex]
+            vertex = edges[vertex]
+
+        if vertex in on_path or vertex in broken_vertices:
+            # the walk ran into a cycle
+            broken_vertices.update(dict.fromkeys(visited))
+            continue
 
-        # vertex is now a leaf
+        # vertex is now a leaf or a vertex with a known leaf
+        leaf = redirects.get(vertex, vertex)
         for visited_vertex in visited:
-            redirects[visited_vertex] = vertex
+            redirects[visited_vertex] = leaf
 
     if broken_vertices:
         err_msg = (
             f"rediraffe: At least 1 circular redirect detected. All involved links: "
-            + ", ".join(broken_vertices)
+            + ", ".join(map(name, broken_vertices))
         )
         logger.error(err_msg)
         raise ExtensionError(err_msg)
@@ -121,339 +188,2442 @@ def create_simple_redirects(graph_edges: dict) -> dict:
     return redirects
 
 
-def remove_suffix(docname: str, suffixes: List[str]) -> str:
-    """Remove any known suffixes for a file path."""
-    for suffix in suffixes:
-        if docname.endswith(suffix):
-            return docname[: -len(suffix)]
-    return docname
+class _RedirectGraph:
+    """
+    A redirect graph in which every path is interned once as an integer id.
 
+    Edges are stored as parent pointers: parents[vertex] is the id the vertex is
+    redirected to, or -1 if the vertex is not redirected.
+    """
 
-def build_redirects(app: Sphinx, exception: Union[Exception, None]) -> None:
+    def __init__(self) -> None:
+        self.paths: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self.parents = array("l")
+        # prefix redirects as (source prefix, destination prefix), see split_patterns
+        self.patterns: List[Tuple[str, str]] = []
+
+    @classmethod
+    def from_dict(cls, graph_edges: Dict[str, str]) -> "_RedirectGraph":
+        # sources are numbered first, in order, then destinations that are not redirected
+        ids = dict(zip(graph_edges, range(len(graph_edges))))
+        intern = ids.setdefault
+        parents = array("l", [intern(path, len(ids)) for path in graph_edges.values()])
+        parents.extend(array("l", [-1]) * (len(ids) - len(graph_edges)))
+        return cls.from_arrays(list(ids), parents, ids)
+
+    @classmethod
+    def from_arrays(
+        cls,
+        paths: List[str],
+        parents: "array[int]",
+        ids: Union[Dict[str, int], None] = None,
+    ) -> "_RedirectGraph":
+        graph = cls()
+        graph.paths = paths
+        graph.ids = dict(zip(paths, range(len(paths)))) if ids is None else ids
+        graph.parents = parents
+        return graph
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def intern(self, path: str) -> int:
+        ids = self.ids
+        vertex = ids.setdefault(path, len(ids))
+        if vertex == len(self.paths):
+            self.paths.append(path)
+            self.parents.append(-1)
+        return vertex
+
+    def add_edge(self, edge_from: str, edge_to: str) -> bool:
+        """
+        Add an edge. Returns False, and keeps the latest edge, if edge_from was already redirected.
+        """
+        vertex = self.intern(edge_from)
+        parents = self.parents
+        is_new = parents[vertex] == -1
+        parents[vertex] = self.intern(edge_to)
+        return is_new
+
+    def sources(self) -> Iterator[int]:
+        """Ids of every redirected vertex."""
+        parents = self.parents
+        return (vertex for vertex in range(len(parents)) if parents[vertex] != -1)
+
+    def to_dict(self) -> Dict[str, str]:
+        paths = self.paths
+        return {paths[vertex]: paths[self.parents[vertex]] for vertex in self.sources()}
+
+    def split_patterns(self) -> None:
+        """
+        Move prefix redirects such as ``old/api/* new/api/*`` out of the edges and into
+        patterns. Throws error if a path contains a wildcard anywhere but at its end or only
+        one side of an edge is a pattern.
+        """
+        broken = False
+        paths = self.paths
+        parents = self.parents
+        for vertex in list(self.sources()):
+            edge_from = paths[vertex]
+            edge_to = paths[parents[vertex]]
+            if "*" not in edge_from and "*" not in edge_to:
+                continue
+            if (
+                edge_from.find("*") == len(edge_from) - 1
+                and edge_to.find("*") == len(edge_to) - 1
+            ):
+                self.patterns.append(
+                    (
+                        edge_from[:-1].replace("\\", "/"),
+                        edge_to[:-1].replace("\\", "/"),
+                    )
+                )
+                parents[vertex] = -1
+                continue
+            logger.error(
+                red(
+                    f"rediraffe: {edge_from} {edge_to} is not a valid prefix redirect! Both paths must end with a single *."
+                )
+            )
+            broken = True
+        if broken:
+            err_msg = f"rediraffe: Error(s) in the prefix redirects."
+            logger.error(err_msg)
+            raise ExtensionError(err_msg)
+
+    def resolve(self) -> "array[int]":
+        """
+        Ensures that the graph is acyclic and returns the leaf of every vertex
+        (-1 for vertices that are not redirected), see _resolve_leaves.
+        """
+        parents = self.parents
+        resolved = _resolve_leaves(
+            {vertex: parents[vertex] for vertex in self.sources()},
+            self.paths.__getitem__,
+        )
+        leaves = array("l", [-1]) * len(parents)
+        for vertex, leaf in resolved.items():
+            leaves[vertex] = leaf
+        return leaves
+
+
+def _split_redirect_line(line: str) -> Union[Tuple[str, str], None]:
     """
-    Build amd write redirects
+    Split a stripped, non-comment line of a redirects file into its source and destination.
+    Returns None if the line is invalid.
     """
-    redirect_json_file = Path(app.outdir) / REDIRECT_JSON_NAME
-    if redirect_json_file.exists():
-        redirect_record = json.loads(redirect_json_file.read_text("utf8"))
-    else:
-        redirect_record = {}
+    if '"' not in line and "'" not in line:
+        # fast path: no quoting, so the line must be exactly 2 whitespace delimited paths
+        parts = line.split()
+        if len(parts) != 2:
+            return None
+        return parts[0], parts[1]
 
-    if exception != None:
-        return
+    match = RE_OBJ.fullmatch(line)
+    if match == None:
+        return None
+    return match.group(2) or match.group(3), match.group(5) or match.group(6)
 
-    if isinstance(app.builder, CheckExternalLinksBuilder):
-        logger.info("rediraffe: Redirect generation skipped for linkcheck builders.")
-        return
 
-    if (
-        type(app.builder) not in (StandaloneHTMLBuilder, DirectoryHTMLBuilder)
-        and app.builder.name not in READTHEDOCS_BUILDERS
-    ):
-        logger.info(
-            "rediraffe: Redirect generation skipped for unsupported builders. Supported builders: html, dirhtml, readthedocs, readthedocsdirhtml."
-        )
-        return
+def _parse_redirects_file(path: Path) -> Tuple[Dict[str, str], List[int], bool]:
+    """
+    Parse a redirects file into a dict of redirects, keeping the latest edge of a source
+    that is redirected more than once. Also returns the line numbers of invalid lines and
+    whether any source was redirected more than once. Used by worker processes.
+    """
+    edges: Dict[str, str] = {}
+    invalid: List[int] = []
+    # blank, comment and invalid lines, to count the edges without a lookup per line
+    skipped = 0
+    line_num = 0
+    with open(path, "r") as file:
+        for line_num, line in enumerate(file, start=1):
+            parts = line.split()
+            if not parts or parts[0][0] == "#":
+                skipped += 1
+                continue
+            if len(parts) == 2 and '"' not in line and "'" not in line:
+                # fast path: no quoting, so the line is exactly 2 whitespace delimited paths
+                edges[parts[0]] = parts[1]
+                continue
+            edge = _split_redirect_line(line.strip())
+            if edge is None:
+                invalid.append(line_num)
+                skipped += 1
+                continue
+            edges[edge[0]] = edge[1]
+    return edges, invalid, len(edges) != line_num - skipped
 
-    rediraffe_template = app.config.rediraffe_template
-    if isinstance(rediraffe_template, str):
-        # path
-        template_path = Path(app.srcdir) / rediraffe_template
-        if template_path.exists():
-            file_loader = FileSystemLoader(template_path.parent)
-            env = Environment(loader=file_loader)
-            rediraffe_template = env.get_template(template_path.name)
-        else:
-            logger.warning(
-                "rediraffe: rediraffe_template does not exist. The default will be used."
-            )
-            rediraffe_template = DEFAULT_REDIRAFFE_TEMPLATE
+
+def _report_duplicate_redirects(paths: List[Path], where: Any) -> None:
+    """
+    Log every source that is redirected more than once, with where it was first
+    redirected. Only runs on error, so the files are read again instead of keeping the
+    file and line of every edge while parsing.
+    """
+    first: Dict[str, Tuple[int, int]] = {}
+    for file_index, path in enumerate(paths):
+        with open(path, "r") as file:
+            for line_num, line in enumerate(file, start=1):
+                line = line.strip()
+                if len(line) == 0 or line.startswith("#"):
+                    continue
+                edge = _split_redirect_line(line)
+                if edge is None:
+                    continue
+                location = first.setdefault(edge[0], (file_index, line_num))
+                if location != (file_index, line_num):
+                    # Duplicate vertices not allowed / Vertices can only have 1 outgoing edge
+                    logger.error(
+                        red(
+                            f"rediraffe: {edge[0]} is redirected multiple times in the rediraffe_redirects file! "
+                            f"({where(file_index, line_num)}, first redirected at {where(*location)})"
+                        )
+                    )
+
+
+def _parse_redirects(*paths: Path, root: Union[Path, None] = None) -> Dict[str, str]:
+    """
+    Parse one or more redirects files into a single dict of redirects. Throws error on
+    invalid lines and duplicate keys, including sources redirected in more than one file.
+    Multiple files are parsed concurrently in a process pool.
+    """
+    names = [
+        Path(relpath(path, root)).as_posix() if root else str(path) for path in paths
+    ]
+
+    def where(file_index: int, line_num: int) -> str:
+        if len(paths) == 1:
+            return f"line {line_num}"
+        return f"{names[file_index]}:{line_num}"
+
+    if len(paths) == 1:
+        results = [_parse_redirects_file(paths[0])]
     else:
-        rediraffe_template = DEFAULT_REDIRAFFE_TEMPLATE
+        # multiprocessing is only imported when there is more than one file
+        from concurrent.futures import ProcessPoolExecutor
 
-    graph_edges = {}
+        workers = min(len(paths), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_parse_redirects_file, paths))
 
-    rediraffe_redirects = app.config.rediraffe_redirects
-    if isinstance(rediraffe_redirects, dict):
-        # dict in conf.py
-        graph_edges = rediraffe_redirects
-    elif isinstance(rediraffe_redirects, str):
-        # filename
-        path = Path(app.srcdir) / rediraffe_redirects
-        if not path.is_file():
+    edges: Dict[str, str] = {}
+    broken = duplicated = False
+    for file_index, (file_edges, invalid, file_duplicated) in enumerate(results):
+        for line_num in invalid:
             logger.error(
                 red(
-                    "rediraffe: rediraffe_redirects file does not exist. Redirects will not be generated."
+                    f"rediraffe: {where(file_index, line_num)} of the redirects is invalid!"
                 )
             )
-            app.statuscode = 1
-            return
+            broken = True
+        if file_duplicated or not edges.keys().isdisjoint(file_edges):
+            duplicated = True
+        if edges:
+            edges.update(file_edges)
+        else:
+            edges = file_edges
+    if duplicated:
+        _report_duplicate_redirects(list(paths), where)
+        broken = True
+    if broken:
+        err_msg = f"rediraffe: Error(s) in parsing the redirects file."
+        logger.error(err_msg)
+        raise ExtensionError(err_msg)
+    return edges
 
-        try:
-            graph_edges = create_graph(path)
-        except ExtensionError as e:
-            app.statuscode = 1
-            raise e
-    else:
-        logger.warning(
-            "rediraffe: rediraffe was not given redirects to process. Redirects will not be generated."
-        )
-        return
 
-    try:
-        redirects = create_simple_redirects(graph_edges)
-    except ExtensionError as e:
-        app.statuscode = 1
-        raise e
+def _create_redirect_graph(
+    *paths: Path, root: Union[Path, None] = None
+) -> _RedirectGraph:
+    """
+    Parse one or more redirects files into a single _RedirectGraph. Throws error on duplicate
+    keys, including sources redirected in more than one file.
+    """
+    return _RedirectGraph.from_dict(_parse_redirects(*paths, root=root))
 
-    logger.info("Writing redirects...")
 
-    # write redirects
-    for src_redirect_from, src_redirect_to in redirects.items():
-        # Normalize path - src_redirect_.* is relative so drive letters aren't an issue.
-        src_redirect_from = Path(PureWindowsPath(src_redirect_from))
-        src_redirect_to = Path(PureWindowsPath(src_redirect_to))
+def _format_redirect_path(path: str) -> str:
+    """Quote a path for a redirects file when it would not be read back as written."""
+    if path and path[0] not in "\"'#" and not any(char.isspace() for char in path):
+        return path
+    quote = "'" if '"' in path else '"'
+    return f"{quote}{path}{quote}"
 
-        # remove extensions
-        redirect_from_name = remove_suffix(
-            src_redirect_from.name, app.config.source_suffix
-        )
-        redirect_to_name = remove_suffix(src_redirect_to.name, app.config.source_suffix)
 
-        redirect_from = src_redirect_from.parent / f"{redirect_from_name}.html"
-        redirect_to = src_redirect_to.parent / f"{redirect_to_name}.html"
+class _CompactedRedirects(NamedTuple):
+    text: str
+    entries: int
+    collapsed: int
+    duplicates: int
+    dropped: int
 
-        if type(app.builder) == DirectoryHTMLBuilder:
-            if redirect_from_name != "index":
-                redirect_from = (
-                    src_redirect_from.parent / redirect_from_name / "index.html"
+
+def _compact_redirects(
+    path: Path, existing: Union[Set[str], None] = None
+) -> _CompactedRedirects:
+    """
+    Rewrite a redirects file in canonical form: entries sorted by source, every chain
+    collapsed to its leaf and exact duplicates dropped. If existing, a set of posix paths
+    relative to the redirects' root, is given, redirects from those paths are dropped too.
+
+    A comment block at the top of the file followed by a blank line stays at the top, other
+    comments move with the entry that follows them and trailing comments stay at the end.
+    Throws error if the file is invalid, or if the compacted redirects would not be read
+    back as written or would not resolve the same as before.
+    """
+    header: List[str] = []
+    comments: List[str] = []
+    entries: Dict[Tuple[str, str], List[str]] = {}
+    source_lines: Dict[str, int] = {}
+    duplicates = 0
+    broken = False
+    with open(path, "r") as file:
+        for line_num, line in enumerate(file, start=1):
+            line = line.strip()
+            if len(line) == 0:
+                if comments and not header and not entries:
+                    header, comments = comments, []
+                continue
+            if line.startswith("#"):
+                comments.append(line)
+                continue
+            edge = _split_redirect_line(line)
+            if edge is None:
+                logger.error(
+                    red(f"rediraffe: line {line_num} of the redirects is invalid!")
+                )
+                broken = True
+            elif edge in entries:
+                entries[edge] += comments
+                duplicates += 1
+            elif edge[0] in source_lines:
+                logger.error(
+                    red(
+                        f"rediraffe: {edge[0]} is redirected multiple times in the rediraffe_redirects file! "
+                        f"(line {line_num}, first redirected at line {source_lines[edge[0]]})"
+                    )
                 )
-            if redirect_to_name != "index":
-                redirect_to = src_redirect_to.parent / redirect_to_name / "index.html"
+                broken = True
+            else:
+                entries[edge] = comments
+                source_lines[edge[0]] = line_num
+            comments = []
+    if broken:
+        err_msg = f"rediraffe: Error(s) in parsing the redirects file."
+        logger.error(err_msg)
+        raise ExtensionError(err_msg)
 
-        # absolute paths into the build dir
-        build_redirect_from = Path(app.outdir) / redirect_from
-        build_redirect_to = Path(app.outdir) / redirect_to
+    graph = _RedirectGraph.from_dict(dict(entries.keys()))
+    graph.split_patterns()
+    leaves = graph.resolve()
+    before = {
+        edge_from: graph.paths[leaves[graph.ids[edge_from]]]
+        for edge_from, edge_to in entries
+        if "*" not in edge_from
+    }
 
-        if (
-            build_redirect_from.exists()
-            and src_redirect_from.as_posix() in redirect_record
-        ):
-            # if it is still pointing to the same source, continue
-            if (
-                redirect_record[src_redirect_from.as_posix()]
-                == src_redirect_to.as_posix()
-            ):
-                continue
-            # otherwise remove and rewrite
-            build_redirect_from.unlink()
+    def is_existing(edge_from: str) -> bool:
+        return existing is not None and (
+            posixpath.normpath(edge_from.replace("\\", "/")) in existing
+        )
 
-        if build_redirect_from.exists():
-            logger.warning(
-                f'{yellow("(broken)")} {redirect_from} redirects to {redirect_to} but {build_redirect_from} already exists!'
-            )
-            app.statuscode = 1
+    compacted: List[Tuple[str, str, List[str]]] = []
+    collapsed = 0
+    dropped = 0
+    for (edge_from, edge_to), entry_comments in entries.items():
+        if "*" not in edge_from and is_existing(edge_from):
+            dropped += 1
             continue
+        if "*" not in edge_from:
+            leaf = before[edge_from]
+            if leaf != edge_to:
+                collapsed += 1
+            edge_to = leaf
+        compacted.append((edge_from, edge_to, entry_comments))
+    compacted.sort(key=lambda entry: (entry[0], entry[1]))
+
+    lines = list(header)
+    if header:
+        lines.append("")
+    for edge_from, edge_to, entry_comments in compacted:
+        lines += entry_comments
+        line = f"{_format_redirect_path(edge_from)} {_format_redirect_path(edge_to)}"
+        if _split_redirect_line(line) != (edge_from, edge_to):
+            err_msg = f"rediraffe: {edge_from} {edge_to} cannot be written to a redirects file."
+            logger.error(red(err_msg))
+            raise ExtensionError(err_msg)
+        lines.append(line)
+    lines += comments
+
+    # the compacted redirects must resolve exactly like the original ones
+    graph_after = _RedirectGraph.from_dict(
+        {edge_from: edge_to for edge_from, edge_to, _ in compacted}
+    )
+    graph_after.split_patterns()
+    leaves_after = graph_after.resolve()
+    after = {
+        graph_after.paths[vertex]: graph_after.paths[leaves_after[vertex]]
+        for vertex in graph_after.sources()
+    }
+    expected = {
+        edge_from: leaf
+        for edge_from, leaf in before.items()
+        if not is_existing(edge_from)
+    }
+    if after != expected or sorted(graph_after.patterns) != sorted(graph.patterns):
+        err_msg = f"rediraffe: The compacted redirects do not resolve like {path}."
+        logger.error(red(err_msg))
+        raise ExtensionError(err_msg)
 
-        if not build_redirect_to.exists():
-            logger.warning(
-                f'{yellow("(broken)")} {redirect_from} redirects to {redirect_to} but {build_redirect_to} does not exist!'
-            )
-            app.statuscode = 1
-            continue
+    return _CompactedRedirects(
+        "".join(f"{line}\n" for line in lines),
+        len(compacted),
+        collapsed,
+        duplicates,
+        dropped,
+    )
 
-        build_redirect_from.parent.mkdir(parents=True, exist_ok=True)
-        with build_redirect_from.open("w") as f:
-            f.write(
-                rediraffe_template.render(
-                    rel_url=str(
-                        PurePosixPath(
-                            PureWindowsPath(
-                                relpath(build_redirect_to, build_redirect_from.parent)
-                            )
-                        )
-                    ),
-                    from_file=src_redirect_from,
-                    to_file=src_redirect_to,
-                    from_url=redirect_from,
-                    to_url=redirect_to,
+
+def _redirect_files(
+    srcdir: Path, rediraffe_redirects: Union[str, List[str]]
+) -> Union[List[Path], None]:
+    """
+    Expand rediraffe_redirects, a filename or a list of filenames and glob patterns relative
+    to the source directory, into the redirects files. Logs an error and returns None if a
+    file does not exist or a pattern matches no files.
+    """
+    if isinstance(rediraffe_redirects, str):
+        rediraffe_redirects = [rediraffe_redirects]
+
+    paths: Dict[Path, None] = {}
+    for entry in rediraffe_redirects:
+        if any(char in entry for char in "*?["):
+            matches = sorted(path for path in srcdir.glob(entry) if path.is_file())
+            if not matches:
+                logger.error(
+                    red(
+                        f"rediraffe: rediraffe_redirects pattern {entry} does not match any files."
+                    )
                 )
-            )
-            logger.info(
-                f'{green("(good)")} {redirect_from} {green("-->")} {redirect_to}'
-            )
-            redirect_record[src_redirect_from.as_posix()] = src_redirect_to.as_posix()
+                return None
+            paths.update(dict.fromkeys(matches))
+        else:
+            path = srcdir / entry
+            if not path.is_file():
+                logger.error(
+                    red(f"rediraffe: rediraffe_redirects file {entry} does not exist.")
+                )
+                return None
+            paths[path] = None
+    return list(paths)
 
-    redirect_json_file.write_text(json.dumps(redirect_record), encoding="utf8")
 
+def create_graph(path: Path) -> Dict[str, str]:
+    """
+    Convert a file containing a whitespace delimited edge list (key value pairs) to a dict. Throws error on duplicate keys.
+    """
+    return _parse_redirects(path)
 
-class CheckRedirectsDiffBuilder(Builder):
-    name = "rediraffecheckdiff"
 
-    def init(self) -> None:
-        super().init()
+def create_simple_redirects(graph_edges: dict) -> dict:
+    """
+    Ensures that a graph is a acyclic and reconnects every vertex to its leaf vertex.
+    """
+    return _resolve_leaves(graph_edges, str)
 
-        source_suffixes = set(self.app.config.source_suffix)
-        src_path = Path(self.app.srcdir)
 
-        rediraffe_redirects = self.app.config.rediraffe_redirects
-        redirects_path = None
-        if isinstance(rediraffe_redirects, dict):
-            pass
-        elif isinstance(rediraffe_redirects, str):
-            redirects_path = Path(src_path) / rediraffe_redirects
-            if not redirects_path.is_file():
-                logger.error(red("rediraffe: rediraffe_redirects file does not exist."))
-                self.app.statuscode = 1
-                return
+def remove_suffix(docname: str, suffixes: List[str]) -> str:
+    """Remove any known suffixes for a file path."""
+    for suffix in suffixes:
+        if docname.endswith(suffix):
+            return docname[: -len(suffix)]
+    return docname
+
+
+class _DirIndex:
+    """
+    An in-memory index of every file and directory below root, built with a single walk.
+    Existence checks and directory creation go through the index instead of the filesystem,
+    and files that will be written are claimed so two writers of a file are detected.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.files: Set[str] = set()
+        self.dirs: Set[str] = {"."}
+        self.claimed: Set[str] = set()
+
+        pending_dirs = [""]
+        while pending_dirs:
+            rel_dir = pending_dirs.pop()
             try:
-                rediraffe_redirects = create_graph(redirects_path)
-            except ExtensionError as e:
-                self.app.statuscode = 1
-                return
-        else:
-            logger.error("rediraffe: rediraffe was not given redirects to process.")
-            self.app.statuscode = 1
+                entries = list(os.scandir(root / rel_dir))
+            except OSError:
+                continue
+            for entry in entries:
+                rel_path = posixpath.join(rel_dir, entry.name)
+                if entry.is_dir():
+                    self.dirs.add(self._key(rel_path))
+                    pending_dirs.append(rel_path)
+                else:
+                    self.files.add(self._key(rel_path))
+
+    @staticmethod
+    def _key(rel_path: Union[str, PurePath]) -> str:
+        return os.path.normcase(posixpath.normpath(PurePath(rel_path).as_posix()))
+
+    def exists(self, rel_path: Union[str, PurePath]) -> bool:
+        key = self._key(rel_path)
+        return key in self.files or key in self.dirs
+
+    def claim(self, rel_path: Union[str, PurePath]) -> bool:
+        """
+        Add a file that will be written to the index. Returns False if it was already
+        claimed, paths being compared the way the filesystem does.
+        """
+        key = self._key(rel_path)
+        if key in self.claimed:
+            return False
+        self.claimed.add(key)
+        self.files.add(key)
+        return True
+
+    def unlink(self, rel_path: Union[str, PurePath]) -> None:
+        (self.root / rel_path).unlink()
+        self.files.discard(self._key(rel_path))
+
+    def makedirs(self, rel_dir: Union[str, PurePath]) -> None:
+        """Create a directory and its parents unless the index already knows it exists."""
+        rel_dir = posixpath.normpath(PurePath(rel_dir).as_posix())
+        if self._key(rel_dir) in self.dirs:
             return
+        (self.root / rel_dir).mkdir(parents=True, exist_ok=True)
+        while self._key(rel_dir) not in self.dirs:
+            self.dirs.add(self._key(rel_dir))
+            rel_dir = posixpath.dirname(rel_dir) or "."
 
-        absolute_redirects = {
-            (src_path / redirect_from).resolve(): (src_path / redirect_to).resolve()
-            for redirect_from, redirect_to in rediraffe_redirects.items()
-        }
 
-        path_to_git_repo = subprocess.check_output(
-            f"git -C {self.app.srcdir} rev-parse --show-toplevel", shell=True
-        ).decode("utf-8")
+class _Metrics:
+    """
+    Wall time of each phase and redirect counters of one rediraffe run, reported as a
+    summary log line and optionally written to the outdir for CI dashboards.
+    """
 
-        def abs_path_in_src_dir_w_src_suffix(filename: str) -> Union[Path, None]:
-            abs_path = (Path(path_to_git_repo.strip()) / filename.strip()).resolve()
-            if not str(abs_path).startswith(str(src_path)):
-                return None
-            if abs_path.suffix not in source_suffixes:
-                return None
-            return abs_path
+    PHASES = (
+        "load_record",
+        "load_template",
+        "parse",
+        "resolve",
+        "validate",
+        "render",
+        "write",
+        "save_record",
+    )
+    COUNTERS = ("written", "skipped", "rewritten", "removed", "broken")
+
+    def __init__(self, phases: Tuple[str, ...] = PHASES) -> None:
+        # every phase is reported, even if it was skipped, so dashboards get every series
+        self.phases: Dict[str, float] = dict.fromkeys(phases, 0.0)
+        self.counters: Dict[str, int] = dict.fromkeys(self.COUNTERS, 0)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
 
-        # run git diff
-        renamed_files_out = (
-            subprocess.check_output(
-                f"git -C {self.app.srcdir} diff --name-status --diff-filter=R {self.app.config.rediraffe_branch}",
-                shell=True,
-            )
-            .decode("utf-8")
-            .splitlines()
-        )
+    def add_time(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
 
-        rename_hints = {}
-        for line in renamed_files_out:
-            line = line.strip()
-            r_perc, rename_from, rename_to = re.split(r"\s+", line)
-            perc = int(r_perc[1:])
-            path_rename_from = abs_path_in_src_dir_w_src_suffix(rename_from)
-            path_rename_to = abs_path_in_src_dir_w_src_suffix(rename_to)
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
 
-            if path_rename_from == None:
-                continue
-            if path_rename_to == None:
-                continue
-            rename_hints[path_rename_from] = (path_rename_to, perc)
+    def summary(self) -> str:
+        counters = ", ".join(f"{n} {name}" for name, n in self.counters.items())
+        phases = ", ".join(
+            f"{name} {seconds:.3f}s" for name, seconds in self.phases.items()
+        )
+        return f"rediraffe: {counters} ({phases})."
 
-        # run git diff
-        deleted_files = (
-            subprocess.check_output(
-                f"git -C {self.app.srcdir} diff --diff-filter=D --name-only {self.app.config.rediraffe_branch}",
-                shell=True,
-            )
-            .decode("utf-8")
-            .splitlines()
+    def to_json(self, builder: str) -> str:
+        return json.dumps(
+            {"builder": builder, "phases": self.phases, "counters": self.counters},
+            indent=1,
         )
 
-        # to absolute path + filter out
-        deleted_files = [
-            abs_path_in_src_dir_w_src_suffix(filename) for filename in deleted_files
+    def to_prometheus(self, builder: str) -> str:
+        lines = [
+            "# HELP rediraffe_phase_seconds Wall time of each rediraffe phase.",
+            "# TYPE rediraffe_phase_seconds gauge",
         ]
-        deleted_files = list(filter(lambda x: x != None, deleted_files))
+        lines += [
+            f'rediraffe_phase_seconds{{builder="{builder}",phase="{name}"}} {seconds}'
+            for name, seconds in self.phases.items()
+        ]
+        lines += [
+            "# HELP rediraffe_redirects Redirects handled by rediraffe, by outcome.",
+            "# TYPE rediraffe_redirects gauge",
+        ]
+        lines += [
+            f'rediraffe_redirects{{builder="{builder}",outcome="{name}"}} {n}'
+            for name, n in self.counters.items()
+        ]
+        return "\n".join(lines) + "\n"
+
+    def report(self, outdir: Path, builder: str, output: Union[str, None]) -> None:
+        """
+        Log the summary and write the metrics to the outdir in the output format, if any.
+        The file is replaced atomically so collectors never read a partial file.
+        """
+        logger.info(self.summary())
+        if not output:
+            return
+        if output not in METRICS_NAMES:
+            logger.warning(
+                f"rediraffe: rediraffe_metrics must be one of {', '.join(METRICS_NAMES)}, not {output}."
+            )
+            return
+        content = (
+            self.to_json(builder) if output == "json" else self.to_prometheus(builder)
+        )
+        metrics_path = Path(outdir) / METRICS_NAMES[output]
+        metrics_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = metrics_path.with_name(metrics_path.name + ".tmp")
+        tmp_path.write_text(content, encoding="utf8")
+        os.replace(tmp_path, metrics_path)
 
-        for deleted_file in deleted_files:
-            if deleted_file in absolute_redirects:
-                logger.info(
-                    f"deleted file {deleted_file} redirects to {absolute_redirects[deleted_file]}."
-                )
-            else:
-                err_msg = f'{red("(broken)")} {deleted_file} was deleted but is not redirected!'
-                logger.error(err_msg)
-                self.app.statuscode = 1
 
-        with redirects_path.open("a") as redirects_file:
-            for renamed_file in rename_hints:
-                hint_to, perc = rename_hints[renamed_file]
+class _PendingRedirect(NamedTuple):
+    """A redirect stub that passed all checks and is waiting to be rendered."""
 
-                if renamed_file in absolute_redirects:
-                    logger.info(
-                        f"renamed file {renamed_file} redirects to {absolute_redirects[renamed_file]}."
-                    )
-                    continue
+    src_redirect_from: Path
+    src_redirect_to: Path
+    redirect_from: Path
+    redirect_to: Path
+    build_redirect_from: Path
+    build_redirect_to: Path
+    # whether a file is already at redirect_from, whether the redirect record has the
+    # source and, if known, the hash of the stub that was written for it
+    exists: bool = False
+    recorded: bool = False
+    previous_hash: Union[str, None] = None
 
-                if self.name == "rediraffewritediff":
-                    if perc >= self.app.config.rediraffe_auto_redirect_perc:
-                        rel_rename_from = f'"{str(PurePosixPath(renamed_file.relative_to(src_path)))}"'
-                        rel_rename_to = (
-                            f'"{str(PurePosixPath(hint_to.relative_to(src_path)))}"'
-                        )
-                        redirects_file.write(f"{rel_rename_from} {rel_rename_to}\n")
-                        logger.info(
-                            f"{green('(okay)')} Renamed file {rel_rename_from} has been redirected to {rel_rename_to} in your redirects file!"
-                        )
-                        continue
 
-                err_msg = (
-                    f"{red('(broken)')} {renamed_file} was deleted but is not redirected!"
-                    f" Hint: This file was renamed to {hint_to} with a similarity of {perc}%."
-                )
-                logger.error(err_msg)
-                self.app.statuscode = 1
+def _stub_hash(content: bytes) -> str:
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
 
-    def get_outdated_docs(self):
-        return []
 
-    def prepare_writing(self=None, docnames=None):
-        pass
+class _RedirectRecord:
+    """
+    The redirect stubs written into an outdir by previous builds, stored in the outdir as
+    the sqlite database REDIRECT_DB_NAME. Maps every source to its destination and the
+    hash of its stub, and keeps the hash of the template the stubs were rendered with and
+    the digest of the redirects of the last build (see _plan_digest).
+
+    Lookups query the database. Added redirects are inserted in batches, and all changes
+    are committed in one transaction by save, so a build only reads and writes the rows
+    of the redirects it looks at. A record without a database is kept in memory until it
+    is saved, so only builds that write redirects create one. JSON records of older
+    versions (REDIRECT_JSON_NAME) are migrated when loaded. Records that only map sources
+    to destinations have no stub hashes; their stubs are compared with the files in the
+    outdir instead.
+    """
 
-    def write_doc(self, docname=None, doctree=None):
-        pass
+    VERSION = 3
+
+    def __init__(self, path: Union[Path, None] = None) -> None:
+        import sqlite3
+
+        self.path = path
+        self.on_disk = path is not None and path.exists()
+        self.db = sqlite3.connect(str(path) if self.on_disk else ":memory:")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.VERSION:
+            self.db.executescript(
+                f"""
+                DROP TABLE IF EXISTS redirects;
+                DROP TABLE IF EXISTS meta;
+                CREATE TABLE redirects (
+                    source TEXT PRIMARY KEY,
+                    target TEXT NOT NULL,
+                    hash TEXT,
+                    fresh INTEGER NOT NULL
+                ) WITHOUT ROWID;
+                CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+                PRAGMA user_version = {self.VERSION};
+                """
+            )
+        meta = dict(self.db.execute("SELECT key, value FROM meta"))
+        self.template: Union[str, None] = meta.get("template")
+        self.digest: Union[str, None] = meta.get("digest")
+        # the stub hashes were rendered with another template, see use_template
+        self._stale = False
+        # rows added since the last query
+        self._added: List[Tuple[str, str, Union[str, None], bool]] = []
+
+    @classmethod
+    def load(cls, outdir: Path) -> "_RedirectRecord":
+        outdir = Path(outdir)
+        record = cls(outdir / REDIRECT_DB_NAME)
+        redirect_json_file = outdir / REDIRECT_JSON_NAME
+        if redirect_json_file.exists():
+            record._migrate(json.loads(redirect_json_file.read_text("utf8")))
+            redirect_json_file.unlink()
+        return record
+
+    def _migrate(self, data: Dict[str, Any]) -> None:
+        """Replace the record with a JSON record of an older version."""
+        if data.get("version") == 2:
+            # {"version": 2, "template": hash, "redirects": {source: [destination, hash]}}
+            redirects = data["redirects"]
+            self.template = data["template"]
+        else:
+            # {source: destination}
+            redirects = {source: [target, None] for source, target in data.items()}
+            self.template = None
+        self.digest = None
+        self._stale = False
+        self.db.execute("DELETE FROM redirects")
+        self.db.executemany(
+            "INSERT INTO redirects VALUES (?, ?, ?, ?)",
+            (
+                (source, target, stub_hash, stub_hash is not None)
+                for source, (target, stub_hash) in redirects.items()
+            ),
+        )
+        self.save()
 
-    def get_target_uri(self, docname=None, typ=None):
-        return ""
+    def save(self) -> None:
+        self._begin_changes()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+            [("template", self.template), ("digest", self.digest)],
+        )
+        self.db.commit()
+        if self.path is not None and not self.on_disk:
+            import sqlite3
+
+            db = sqlite3.connect(str(self.path))
+            self.db.backup(db)
+            self.db.close()
+            self.db = db
+            self.on_disk = True
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self) -> "_RedirectRecord":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _begin_changes(self) -> None:
+        # hashes are only forgotten in the database by the record that is saved
+        if self._stale:
+            self.db.execute("UPDATE redirects SET fresh = 0 WHERE fresh")
+            self._stale = False
+        self._flush()
+
+    def _flush(self) -> None:
+        if self._added:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO redirects VALUES (?, ?, ?, ?)", self._added
+            )
+            self._added.clear()
+
+    def lookup(self, source: str) -> Union[Tuple[str, Union[str, None]], None]:
+        """The destination and stub hash of source, or None if it is not recorded."""
+        self._flush()
+        row = self.db.execute(
+            "SELECT target, hash, fresh FROM redirects WHERE source = ?", (source,)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1] if row[2] and not self._stale else None
+
+    def __contains__(self, source: str) -> bool:
+        return self.lookup(source) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        self._flush()
+        return (source for source, in self.db.execute("SELECT source FROM redirects"))
+
+    def __len__(self) -> int:
+        self._flush()
+        return self.db.execute("SELECT count(*) FROM redirects").fetchone()[0]
+
+    def with_prefix(self, prefix: str) -> List[str]:
+        """The recorded sources starting with prefix."""
+        if not prefix:
+            return list(self)
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        self._flush()
+        return [
+            source
+            for source, in self.db.execute(
+                "SELECT source FROM redirects WHERE source >= ? AND source < ?",
+                (prefix, end),
+            )
+        ]
 
-    def read(self):
-        return []
+    def target(self, source: str) -> Union[str, None]:
+        entry = self.lookup(source)
+        return None if entry is None else entry[0]
 
+    def stub_hash(self, source: str) -> Union[str, None]:
+        entry = self.lookup(source)
+        return None if entry is None else entry[1]
 
-class WriteRedirectsDiffBuilder(CheckRedirectsDiffBuilder):
-    name = "rediraffewritediff"
+    def add(self, source: str, target: str, stub_hash: Union[str, None]) -> None:
+        if self._stale:
+            self._begin_changes()
+        self._added.append((source, target, stub_hash, stub_hash is not None))
 
-    def init(self) -> None:
-        rediraffe_redirects = self.app.config.rediraffe_redirects
-        if not isinstance(rediraffe_redirects, str):
-            logger.error(
-                f"{red('(broken)')} Automatic redirects is only available with a redirects file."
-            )
-            self.app.statuscode = 1
-            return
+    def use_template(self, template_hash: Union[str, None]) -> None:
+        """
+        Switch to stubs rendered with the template of template_hash. If the template
+        changed or is unknown (None), the recorded stub hashes no longer say whether a stub
+        is up to date, so they are forgotten.
+        """
+        if template_hash is None or template_hash != self.template:
+            self._stale = True
+        self.template = template_hash
 
-        super().init()
+    def written_hash(self, source: str) -> Union[str, None]:
+        """The hash of the stub written for source, even with a previous template."""
+        self._flush()
+        row = self.db.execute(
+            "SELECT hash FROM redirects WHERE source = ?", (source,)
+        ).fetchone()
+        return None if row is None else row[0]
 
+    def remove(self, source: str) -> None:
+        self._begin_changes()
+        self.db.execute("DELETE FROM redirects WHERE source = ?", (source,))
 
-def setup(app: Sphinx) -> Dict[str, Any]:
-    app.add_config_value("rediraffe_redirects", None, None)
-    app.add_config_value("rediraffe_branch", "", None)
-    app.add_config_value("rediraffe_template", None, None)
-    app.add_config_value("rediraffe_auto_redirect_perc", 100, None)
 
-    app.add_builder(CheckRedirectsDiffBuilder)
-    app.add_builder(WriteRedirectsDiffBuilder)
-    app.connect("build-finished", build_redirects)
+_Manifest = Dict[str, List[Dict[str, str]]]
 
-    return {
+
+def _new_manifest() -> _Manifest:
+    return {"created": [], "rewritten": [], "removed": []}
+
+
+def _write_manifest(outdir: Path, manifest: _Manifest) -> None:
+    """
+    Write the stubs created, rewritten and removed by this build, with the hash of their
+    content, to the outdir for incremental deploys. The file is replaced atomically.
+    """
+    manifest_path = Path(outdir) / MANIFEST_JSON_NAME
+    tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    tmp_path.write_text(
+        json.dumps({"version": 1, "hash": "blake2b-128", **manifest}, indent=1),
+        encoding="utf8",
+    )
+    os.replace(tmp_path, manifest_path)
+
+
+def _template_hash(
+    template: Template, source_suffix: List[str], dirhtml: bool
+) -> Union[str, None]:
+    """
+    A hash of everything a stub is rendered from besides its redirect: the layout and the
+    source of the template and of every template it extends, includes or imports. Returns
+    None if the sources cannot be found, e.g. for templates created from strings.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps([list(source_suffix), dirhtml]).encode("utf8"))
+    if template is _default_template():
+        digest.update(_DEFAULT_TEMPLATE_SOURCE.encode("utf8"))
+        return digest.hexdigest()
+    env = template.environment
+    if template.name is None or env.loader is None:
+        return None
+
+    from jinja2 import TemplateNotFound, meta
+
+    names = [template.name]
+    seen: Set[str] = set()
+    while names:
+        name = names.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        try:
+            source = env.loader.get_source(env, name)[0]
+        except TemplateNotFound:
+            return None
+        digest.update(f"{name}\0{source}\0".encode("utf8"))
+        for referenced in meta.find_referenced_templates(env.parse(source)):
+            if referenced is None:
+                # the name is only known when rendering
+                return None
+            names.append(referenced)
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _default_template() -> Template:
+    """The default redirect template, compiled once on first use."""
+    from jinja2 import Template
+
+    return Template(_DEFAULT_TEMPLATE_SOURCE)
+
+
+@lru_cache(maxsize=None)
+def _template_environment(
+    template_dir: Path, cache_dir: Union[Path, None]
+) -> Environment:
+    """
+    The jinja environment for the templates in template_dir, shared by every build in the
+    process. The environment keeps compiled templates in memory and recompiles them when
+    their file is modified. If cache_dir is given, compiled templates are also kept there
+    between processes, keyed by template name and checked against a hash of the source.
+    """
+    from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+    bytecode_cache = None
+    if cache_dir is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(str(cache_dir))
+    return Environment(
+        loader=FileSystemLoader(template_dir),
+        bytecode_cache=bytecode_cache,
+        auto_reload=True,
+    )
+
+
+def _load_template(
+    template_path: Path, cache_dir: Union[Path, None] = None
+) -> Template:
+    """
+    Load a jinja template file, resolving includes relative to its directory. Compiled
+    templates are reused, see _template_environment.
+    """
+    env = _template_environment(template_path.parent.resolve(), cache_dir)
+    return env.get_template(template_path.name)
+
+
+_StubResult = Tuple[_PendingRedirect, str, str]
+
+
+def _write_redirect_batch(
+    template: Template, batch: List[_PendingRedirect]
+) -> Tuple[List[_StubResult], float, float]:
+    """
+    Render every stub of a batch and write the stubs whose content changed, so unchanged
+    files keep their mtime. All stubs in a batch share an output directory, which must
+    already exist.
+
+    Returns (stub, outcome, hash of the stub) for every stub and the time spent rendering
+    and writing. The outcome is written, rewritten, skipped if the file already has the
+    same content, or broken if a file that is not in the record is in the way.
+    """
+    results = []
+    render_time = write_time = 0.0
+    for pending in batch:
+        start = time.perf_counter()
+        content = template.render(
+            rel_url=_rel_url(pending.redirect_from, pending.redirect_to),
+            from_file=pending.src_redirect_from,
+            to_file=pending.src_redirect_to,
+            from_url=pending.redirect_from,
+            to_url=pending.redirect_to,
+        ).encode("utf8")
+        stub_hash = _stub_hash(content)
+        rendered = time.perf_counter()
+        outcome = "written"
+        if pending.exists:
+            previous_hash = pending.previous_hash
+            if previous_hash is None:
+                try:
+                    previous_hash = _stub_hash(pending.build_redirect_from.read_bytes())
+                except OSError:
+                    pass
+            if previous_hash == stub_hash:
+                outcome = "skipped"
+            elif pending.recorded:
+                outcome = "rewritten"
+            else:
+                outcome = "broken"
+        if outcome in ("written", "rewritten"):
+            with pending.build_redirect_from.open("wb") as f:
+                f.write(content)
+        render_time += rendered - start
+        write_time += time.perf_counter() - rendered
+        results.append((pending, outcome, stub_hash))
+    return results, render_time, write_time
+
+
+def _write_redirect_batches(
+    template: Template, batches: List[List[_PendingRedirect]], parallel: int
+) -> Iterator[Tuple[List[_StubResult], float, float]]:
+    """
+    Write batches of redirect stubs, yielding the results of each batch with its render and
+    write times once it has been written. Batches are yielded in order so logging and the redirect record do not depend on
+    the number of workers.
+    """
+    if parallel <= 1 or len(batches) <= 1:
+        for batch in batches:
+            yield _write_redirect_batch(template, batch)
+        return
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [
+            executor.submit(_write_redirect_batch, template, batch) for batch in batches
+        ]
+        for future in futures:
+            yield future.result()
+
+
+class _PrefixTrie:
+    """
+    A character trie of prefixes. Finding the longest prefix of a path costs O(len(path)),
+    regardless of the number of prefixes.
+    """
+
+    def __init__(self) -> None:
+        self.root: Dict[Any, Any] = {}
+
+    def insert(self, prefix: str, value: Any) -> None:
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        # None is never a character, so it marks the end of a prefix
+        node[None] = (prefix, value)
+
+    def longest_match(self, path: str) -> Union[Tuple[str, Any], None]:
+        """Return (prefix, value) for the longest inserted prefix of path, if any."""
+        node = self.root
+        match = node.get(None)
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            match = node.get(None, match)
+        return match
+
+
+def _expand_patterns(
+    graph: _RedirectGraph,
+    leaves: "array[int]",
+    found_paths: Set[str],
+    redirect_record: _RedirectRecord,
+) -> "array[int]":
+    """
+    Expand the prefix redirects of graph into edges and return the updated leaves.
+
+    A document matching a destination prefix is redirected to from the same path under the
+    source prefix, and a previously written redirect matching a source prefix keeps
+    redirecting under the destination prefix. The longest matching prefix wins and explicit
+    redirects take precedence over expanded ones. Several source prefixes may share a
+    destination prefix, e.g. when two old trees were merged into one, and each of them is
+    expanded.
+    """
+    # source prefixes are unique, destination prefixes are not
+    sources_by_destination: Dict[str, List[str]] = {}
+    by_source = _PrefixTrie()
+    for prefix_from, prefix_to in graph.patterns:
+        sources_by_destination.setdefault(prefix_to, []).append(prefix_from)
+        by_source.insert(prefix_from, prefix_to)
+    by_destination = _PrefixTrie()
+    for prefix_to, prefixes_from in sources_by_destination.items():
+        by_destination.insert(prefix_to, prefixes_from)
+
+    paths = graph.paths
+    parents = graph.parents
+    expanded: Dict[str, str] = {}
+
+    def is_redirected(path: str) -> bool:
+        vertex = graph.ids.get(path)
+        return vertex is not None and parents[vertex] != -1
+
+    for found_path in found_paths:
+        match = by_destination.longest_match(found_path)
+        if match is None:
+            continue
+        prefix_to, prefixes_from = match
+        for prefix_from in prefixes_from:
+            redirect_from = prefix_from + found_path[len(prefix_to) :]
+            if redirect_from not in found_paths and not is_redirected(redirect_from):
+                expanded[redirect_from] = found_path
+
+    recorded = {
+        redirect_from
+        for prefix_from, _ in graph.patterns
+        for redirect_from in redirect_record.with_prefix(prefix_from)
+    }
+    for redirect_from in recorded:
+        if redirect_from in expanded or is_redirected(redirect_from):
+            continue
+        match = by_source.longest_match(redirect_from)
+        if match is None:
+            continue
+        prefix_from, prefix_to = match
+        redirect_to = prefix_to + redirect_from[len(prefix_from) :]
+        if redirect_to in found_paths or is_redirected(redirect_to):
+            expanded[redirect_from] = redirect_to
+
+    if not expanded:
+        return leaves
+
+    vertices = len(paths)
+    for redirect_from, redirect_to in expanded.items():
+        graph.add_edge(redirect_from, redirect_to)
+    leaves.extend(array("l", [-1]) * (len(paths) - vertices))
+
+    # expanded sources redirect to a document or into an explicit chain
+    for redirect_from, redirect_to in expanded.items():
+        vertex = graph.ids[redirect_to]
+        leaf = leaves[vertex] if leaves[vertex] != -1 else vertex
+        leaves[graph.ids[redirect_from]] = leaf
+
+    # explicit chains that end at an expanded source continue to its destination
+    for vertex in range(vertices):
+        leaf = leaves[vertex]
+        if leaf != -1 and leaves[leaf] != -1:
+            leaves[vertex] = leaves[leaf]
+
+    return leaves
+
+
+def _read_resolved_cache(
+    cache_path: Path, key: str
+) -> Union[Tuple[_RedirectGraph, "array[int]"], None]:
+    try:
+        with cache_path.open("rb") as f:
+            cached = pickle.load(f)
+        if cached["key"] != key:
+            return None
+        graph = _RedirectGraph.from_arrays(cached["paths"], cached["parents"])
+        graph.patterns = cached["patterns"]
+        return graph, cached["leaves"]
+    except Exception:
+        # missing, stale or unreadable caches are rebuilt
+        return None
+
+
+def _write_resolved_cache(
+    cache_path: Path, key: str, graph: _RedirectGraph, leaves: "array[int]"
+) -> None:
+    cached = {
+        "key": key,
+        "paths": graph.paths,
+        "parents": graph.parents,
+        "patterns": graph.patterns,
+        "leaves": leaves,
+    }
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first so concurrent builds never read a partial cache
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        with tmp_path.open("wb") as f:
+            pickle.dump(cached, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning(f"rediraffe: could not write the redirects cache: {e}")
+
+
+def _load_resolved_graph(
+    app: Sphinx, metrics: _Metrics
+) -> Union[Tuple[_RedirectGraph, "array[int]"], None]:
+    """
+    Parse and resolve rediraffe_redirects. Returns the graph and the leaf of every vertex,
+    or None if there is nothing to redirect.
+
+    The result is cached in the doctree directory, keyed by a hash of the redirect sources,
+    so builds with unchanged redirects skip parsing and resolution. Builders sharing a
+    doctree directory share the cache.
+    """
+    with metrics.phase("parse"):
+        digest = hashlib.sha256(f"{RESOLVED_CACHE_VERSION}\0".encode("utf8"))
+        rediraffe_redirects = app.config.rediraffe_redirects
+        if isinstance(rediraffe_redirects, dict):
+            # dict in conf.py
+            digest.update(
+                json.dumps(rediraffe_redirects, sort_keys=True, default=str).encode(
+                    "utf8"
+                )
+            )
+        elif isinstance(rediraffe_redirects, (str, list, tuple)):
+            # filename(s) and glob patterns
+            paths = _redirect_files(Path(app.srcdir), rediraffe_redirects)
+            if paths is None:
+                logger.error(red("rediraffe: Redirects will not be generated."))
+                app.statuscode = 1
+                return None
+            for path in paths:
+                digest.update(
+                    f"{path.relative_to(app.srcdir).as_posix()}\0".encode("utf8")
+                )
+                with path.open("rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(chunk)
+                digest.update(b"\0")
+        else:
+            logger.warning(
+                "rediraffe: rediraffe was not given redirects to process. Redirects will not be generated."
+            )
+            return None
+
+        key = digest.hexdigest()
+        cache_path = Path(app.doctreedir) / RESOLVED_CACHE_NAME
+        resolved = _read_resolved_cache(cache_path, key)
+        if resolved is not None:
+            logger.verbose("rediraffe: using cached redirects.")
+            return resolved
+
+        try:
+            if isinstance(rediraffe_redirects, dict):
+                graph = _RedirectGraph.from_dict(rediraffe_redirects)
+            else:
+                graph = _create_redirect_graph(*paths, root=Path(app.srcdir))
+            graph.split_patterns()
+        except ExtensionError as e:
+            app.statuscode = 1
+            raise e
+
+    try:
+        with metrics.phase("resolve"):
+            leaves = graph.resolve()
+    except ExtensionError as e:
+        app.statuscode = 1
+        raise e
+
+    _write_resolved_cache(cache_path, key, graph, leaves)
+    return graph, leaves
+
+
+def _builder_class(module: str, name: str) -> Union[type, None]:
+    """
+    A builder class if its module has already been imported. The running builder can only
+    be an instance of an imported class, so builder checks never need to import one.
+    """
+    builder_module = sys.modules.get(module)
+    return None if builder_module is None else getattr(builder_module, name, None)
+
+
+def _is_linkcheck(builder: Builder) -> bool:
+    linkcheck = _builder_class("sphinx.builders.linkcheck", "CheckExternalLinksBuilder")
+    return linkcheck is not None and isinstance(builder, linkcheck)
+
+
+def _is_dirhtml(builder: Builder) -> bool:
+    return type(builder) is _builder_class(
+        "sphinx.builders.dirhtml", "DirectoryHTMLBuilder"
+    )
+
+
+def _supports_redirects(builder: Builder) -> bool:
+    return (
+        type(builder) is _builder_class("sphinx.builders.html", "StandaloneHTMLBuilder")
+        or _is_dirhtml(builder)
+        or builder.name in READTHEDOCS_BUILDERS
+    )
+
+
+def _redirect_url(src_path: Path, source_suffix: List[str], dirhtml: bool) -> Path:
+    """
+    Path relative to the outdir of the html file built for src_path, for the html
+    (dirhtml=False) or dirhtml layout.
+    """
+    # remove extensions
+    name = remove_suffix(src_path.name, source_suffix)
+    if dirhtml and name != "index":
+        return src_path.parent / name / "index.html"
+    return src_path.parent / f"{name}.html"
+
+
+def _redirect_urls(
+    src_redirect_from: Path,
+    src_redirect_to: Path,
+    source_suffix: List[str],
+    dirhtml: bool,
+) -> Tuple[Path, Path]:
+    """
+    Paths of the redirecting file and of its destination relative to the outdir.
+    """
+    return (
+        _redirect_url(src_redirect_from, source_suffix, dirhtml),
+        _redirect_url(src_redirect_to, source_suffix, dirhtml),
+    )
+
+
+def _resolve_redirects(
+    app: Sphinx, redirect_record: _RedirectRecord, metrics: _Metrics
+) -> Union[Tuple[_RedirectGraph, "array[int]"], None]:
+    """
+    Load and resolve the redirects, then expand prefix redirects against the documents
+    found by Sphinx.
+    """
+    resolved = _load_resolved_graph(app, metrics)
+    if resolved is None or not resolved[0].patterns:
+        return resolved
+    graph, leaves = resolved
+    with metrics.phase("resolve"):
+        found_paths = {
+            PurePath(app.env.doc2path(docname, False)).as_posix()
+            for docname in app.env.found_docs
+        }
+        return graph, _expand_patterns(graph, leaves, found_paths, redirect_record)
+
+
+@contextmanager
+def _profiling(doctreedir: Path, name: str) -> Iterator[None]:
+    """
+    Run the body under cProfile and tracemalloc, then write rediraffe_<name>.prof and an
+    allocation snapshot, rediraffe_<name>.tracemalloc, to the doctree directory. Load them
+    with pstats.Stats and tracemalloc.Snapshot.load.
+    """
+    import cProfile
+    import tracemalloc
+
+    # leave tracing alone if someone else started it
+    start_tracing = not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start(25)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        if start_tracing:
+            tracemalloc.stop()
+        doctreedir.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(doctreedir / f"rediraffe_{name}.prof")
+        snapshot.dump(str(doctreedir / f"rediraffe_{name}.tracemalloc"))
+        logger.info(
+            f"rediraffe: wrote the profile and allocation snapshot of {name} to {doctreedir}."
+        )
+
+
+def _profiled(func: Any) -> Any:
+    """Profile an event handler taking the app first when rediraffe_profile is set."""
+
+    @wraps(func)
+    def wrapper(app: Sphinx, *args: Any) -> Any:
+        if not app.config.rediraffe_profile:
+            return func(app, *args)
+        with _profiling(Path(app.doctreedir), func.__name__):
+            return func(app, *args)
+
+    return wrapper
+
+
+class _EarlyRedirects:
+    """
+    Redirect stubs written while the html builder is still writing documents. The stubs
+    redirecting to a document are handed to a background thread as soon as the builder
+    starts writing that document, see write_early_redirects.
+
+    Stubs redirecting to files that are not documents are left to build_redirects.
+    """
+
+    def __init__(
+        self,
+        template: Template,
+        template_hash: Union[str, None],
+        outdir_index: _DirIndex,
+        dirhtml: bool,
+        by_target: Dict[str, List[_PendingRedirect]],
+    ) -> None:
+        self.template = template
+        self.template_hash = template_hash
+        self.outdir_index = outdir_index
+        self.dirhtml = dirhtml
+        self.by_target = by_target
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures: List[Any] = []
+
+    def page_written(self, pagename: str) -> None:
+        url = _redirect_url(Path(pagename), [], self.dirhtml).as_posix()
+        batch = self.by_target.pop(url, None)
+        if not batch:
+            return
+        for pending in batch:
+            self.outdir_index.makedirs(pending.redirect_from.parent)
+        self.futures.append(
+            self.executor.submit(_write_redirect_batch, self.template, batch)
+        )
+
+    def finish(self) -> Iterator[Tuple[List[_StubResult], float, float]]:
+        """Wait for the stubs written so far, yielding them in the order pages were written."""
+        try:
+            for future in self.futures:
+                yield future.result()
+        finally:
+            self.executor.shutdown()
+
+
+def _early_redirects(
+    app: Sphinx,
+    valid: List[Tuple[Path, Path, Path, Path]],
+    redirect_record: _RedirectRecord,
+) -> Union[_EarlyRedirects, None]:
+    """
+    Prepare writing the stubs of valid redirects, given as (from file, to file, from url,
+    to url), while the html builder writes their destinations. Stubs that the outdir or
+    html_extra_path may conflict with are left to build_redirects, which reports them.
+    Returns None if the stubs cannot be written early.
+    """
+    if app.parallel > 1:
+        # parallel writers are forked, which is unsafe with a live background thread
+        logger.verbose(
+            "rediraffe: rediraffe_early_write is ignored in parallel builds. Redirects will be written after the build."
+        )
+        return None
+
+    rediraffe_template = app.config.rediraffe_template
+    if isinstance(rediraffe_template, str):
+        template_path = Path(app.srcdir) / rediraffe_template
+        if not template_path.exists():
+            # the template may be generated during the build
+            logger.verbose(
+                "rediraffe: rediraffe_template does not exist yet. Redirects will be written after the build."
+            )
+            return None
+        template = _load_template(
+            template_path, Path(app.doctreedir) / TEMPLATE_CACHE_NAME
+        )
+    else:
+        template = _default_template()
+
+    dirhtml = _is_dirhtml(app.builder)
+    template_hash = _template_hash(template, list(app.config.source_suffix), dirhtml)
+    redirect_record.use_template(template_hash)
+    doc_urls = {
+        _redirect_url(Path(docname), [], dirhtml).as_posix()
+        for docname in app.env.found_docs
+    }
+    # _plan_redirects reports these as broken, but a stub written early must never be
+    # overwritten by, or overwrite, a page written after the documents
+    generated_urls = {
+        _redirect_url(Path(pagename), [], dirhtml).as_posix()
+        for pagename in _generated_pages(app)
+    }
+    extra_dirs = [Path(app.confdir) / extra for extra in app.config.html_extra_path]
+    outdir = Path(app.outdir)
+    outdir_index = _DirIndex(outdir)
+    by_target: Dict[str, List[_PendingRedirect]] = {}
+    for src_redirect_from, src_redirect_to, redirect_from, redirect_to in valid:
+        if redirect_to.as_posix() not in doc_urls:
+            continue
+        if redirect_from.as_posix() in generated_urls:
+            continue
+        if any((extra_dir / redirect_from).exists() for extra_dir in extra_dirs):
+            continue
+        exists = outdir_index.exists(redirect_from)
+        entry = redirect_record.lookup(src_redirect_from.as_posix())
+        previous_hash = None if entry is None else entry[1]
+        if exists and (
+            entry is None
+            or entry[0] == src_redirect_to.as_posix()
+            and previous_hash is not None
+        ):
+            # only stubs of a previous build that may be stale are rewritten early
+            continue
+        by_target.setdefault(redirect_to.as_posix(), []).append(
+            _PendingRedirect(
+                src_redirect_from,
+                src_redirect_to,
+                redirect_from,
+                redirect_to,
+                outdir / redirect_from,
+                outdir / redirect_to,
+                exists,
+                exists,
+                previous_hash,
+            )
+        )
+    return _EarlyRedirects(template, template_hash, outdir_index, dirhtml, by_target)
+
+
+# redirects loaded and checked by check_redirects, per application, for build_redirects
+_BuildState = Tuple[Any, Set[str], _Metrics, Union[_EarlyRedirects, None]]
+_build_state: "WeakKeyDictionary[Sphinx, _BuildState]" = WeakKeyDictionary()
+
+
+def _rel_url(redirect_from: PurePath, redirect_to: PurePath) -> str:
+    """The url of redirect_to relative to the redirecting file redirect_from."""
+    return str(
+        PurePosixPath(PureWindowsPath(relpath(redirect_to, redirect_from.parent)))
+    )
+
+
+def _generated_pages(app: Sphinx) -> Set[str]:
+    """
+    Names of the pages the html builders write besides documents: the general and domain
+    indices, the search page and html_additional_pages. Pages that extensions add with
+    html-collect-pages are not known before they are written.
+    """
+    config = app.config
+    pages = set(config.html_additional_pages)
+    # builders like htmlhelp turn off the search page
+    if getattr(app.builder, "search", True):
+        pages.add("search")
+    if config.html_use_index:
+        pages.add("genindex")
+        if config.html_split_index:
+            pages.add("genindex-all")
+    # empty domain indices are not written, which the outdir check reports later
+    indices = config.html_domain_indices
+    if indices:
+        for domain in app.env.domains.values():
+            for index_cls in domain.indices:
+                name = f"{domain.name}-{index_cls.name}"
+                if isinstance(indices, bool) or name in indices:
+                    pages.add(name)
+    return pages
+
+
+def _collects_pages(app: Sphinx) -> bool:
+    """
+    Whether an extension, like viewcode, adds pages with html-collect-pages. Those pages
+    are only known once they are written.
+    """
+    return bool(app.events.listeners.get("html-collect-pages"))
+
+
+def _plan_redirects(
+    app: Sphinx,
+    graph: _RedirectGraph,
+    leaves: "array[int]",
+    found_docs: Set[str],
+    dirhtml: bool,
+) -> Iterator[Tuple[Path, Path, Path, Path, Union[Tuple[Path, str], None]]]:
+    """
+    Compute the urls of every redirect and check them against the documents Sphinx found
+    and the pages the builder generates. Yields (from file, to file, from url, to url,
+    problem), where problem is None or the offending url and the reason the redirect is
+    broken.
+    """
+    suffixes = list(app.config.source_suffix)
+    # every html file that the builder will write for a document or generated page
+    page_urls = {
+        _redirect_url(Path(pagename), [], dirhtml).as_posix()
+        for pagename in (*found_docs, *_generated_pages(app))
+    }
+    extra_dirs = [Path(app.confdir) / extra for extra in app.config.html_extra_path]
+    # stubs of earlier redirects, e.g. a.rst and a.txt or, with dirhtml, a.rst and
+    # a/index.rst both redirect from a/index.html
+    stub_keys: Set[str] = set()
+
+    for vertex in graph.sources():
+        src_redirect_from = Path(PureWindowsPath(graph.paths[vertex]))
+        src_redirect_to = Path(PureWindowsPath(graph.paths[leaves[vertex]]))
+        redirect_from, redirect_to = _redirect_urls(
+            src_redirect_from, src_redirect_to, suffixes, dirhtml
+        )
+
+        problem = None
+        stub_key = os.path.normcase(redirect_from.as_posix())
+        if redirect_from.as_posix() in page_urls or stub_key in stub_keys:
+            problem = (redirect_from, "already exists!")
+        elif redirect_to.as_posix() not in page_urls and not any(
+            (extra_dir / redirect_to).is_file() for extra_dir in extra_dirs
+        ):
+            problem = (redirect_to, "does not exist!")
+        stub_keys.add(stub_key)
+        yield src_redirect_from, src_redirect_to, redirect_from, redirect_to, problem
+
+
+@_profiled
+def check_redirects(app: Sphinx, env: Any) -> None:
+    """
+    Check redirects against the documents found by Sphinx as soon as reading is done, so
+    broken redirects are reported before the write phase. Uses the same checks and
+    warnings as build_redirects, but with set lookups instead of the outdir. Destinations
+    that an extension may still add with html-collect-pages are left to build_redirects.
+    """
+    _build_state.pop(app, None)
+    if _is_linkcheck(app.builder) or not _supports_redirects(app.builder):
+        return
+
+    metrics = _Metrics()
+    with metrics.phase("load_record"):
+        redirect_record = _RedirectRecord.load(app.outdir)
+    with redirect_record:
+        resolved = _resolve_redirects(app, redirect_record, metrics)
+        broken_sources: Set[str] = set()
+        _build_state[app] = (resolved, broken_sources, metrics, None)
+        if resolved is None:
+            return
+        graph, leaves = resolved
+
+        # redirects that passed the checks, only kept to write them early
+        early_write = app.config.rediraffe_early_write
+        collects_pages = _collects_pages(app)
+        valid: List[Tuple[Path, Path, Path, Path]] = []
+        with metrics.phase("validate"):
+            for (
+                src_redirect_from,
+                src_redirect_to,
+                redirect_from,
+                redirect_to,
+                problem,
+            ) in _plan_redirects(
+                app,
+                graph,
+                leaves,
+                env.found_docs,
+                _is_dirhtml(app.builder),
+            ):
+                if problem is None:
+                    if early_write:
+                        valid.append(
+                            (
+                                src_redirect_from,
+                                src_redirect_to,
+                                redirect_from,
+                                redirect_to,
+                            )
+                        )
+                    continue
+                if problem[0] == redirect_to and collects_pages:
+                    # the destination may still be added by an extension, so it is
+                    # checked against the outdir by build_redirects
+                    continue
+                logger.warning(
+                    f'{yellow("(broken)")} {redirect_from} redirects to {redirect_to} but {Path(app.outdir) / problem[0]} {problem[1]}'
+                )
+                broken_sources.add(src_redirect_from.as_posix())
+                metrics.count("broken")
+                app.statuscode = 1
+
+        if early_write:
+            with metrics.phase("load_template"):
+                early = _early_redirects(app, valid, redirect_record)
+            _build_state[app] = (resolved, broken_sources, metrics, early)
+
+
+def write_early_redirects(
+    app: Sphinx, pagename: str, templatename: str, context: Any, doctree: Any
+) -> None:
+    """
+    Start writing the stubs redirecting to a page as the html builder writes it, if
+    rediraffe_early_write is set.
+    """
+    state = _build_state.get(app)
+    if state is not None and state[3] is not None:
+        state[3].page_written(pagename)
+
+
+def _write_redirects(
+    template: Template,
+    graph: _RedirectGraph,
+    leaves: "array[int]",
+    outdir: Path,
+    source_suffix: List[str],
+    dirhtml: bool,
+    redirect_record: _RedirectRecord,
+    broken_sources: Set[str],
+    parallel: int,
+    metrics: _Metrics,
+    manifest: Union[_Manifest, None] = None,
+    early_sources: AbstractSet[str] = frozenset(),
+) -> bool:
+    """
+    Write the redirect stubs of a resolved graph into an already built outdir, remove the
+    stubs of redirects that were dropped, and update the redirect record and the manifest
+    there. Stubs of broken_sources and of early_sources, which were already written, are
+    skipped. Only stubs whose content changed are written. Returns False if any redirect
+    is broken.
+    """
+    if manifest is None:
+        manifest = _new_manifest()
+    broken = metrics.counters["broken"]
+    with metrics.phase("validate"):
+        template_hash = _template_hash(template, source_suffix, dirhtml)
+        redirect_record.use_template(template_hash)
+        digest = _plan_digest(graph, leaves, template_hash, broken_sources)
+    if digest is not None and digest == redirect_record.digest:
+        # the last build wrote the same redirects and left every stub up to date
+        skipped = sum(1 for _ in graph.sources()) - len(broken_sources | early_sources)
+        metrics.count("skipped", skipped)
+        logger.info(f"rediraffe: {skipped} redirects are up to date.")
+        with metrics.phase("save_record"):
+            redirect_record.save()
+            _write_manifest(outdir, manifest)
+        return True
+
+    with metrics.phase("validate"):
+        outdir_index = _DirIndex(outdir)
+        batches, sources, stub_urls = _check_redirects_in_outdir(
+            graph,
+            leaves,
+            outdir,
+            outdir_index,
+            source_suffix,
+            dirhtml,
+            redirect_record,
+            broken_sources | early_sources,
+            metrics,
+        )
+
+    with metrics.phase("write"):
+        for batch in batches.values():
+            outdir_index.makedirs(batch[0].redirect_from.parent)
+        _remove_stale_stubs(
+            redirect_record,
+            sources,
+            stub_urls,
+            outdir,
+            outdir_index,
+            source_suffix,
+            dirhtml,
+            metrics,
+            manifest,
+        )
+
+    for results, render_time, write_time in _write_redirect_batches(
+        template, list(batches.values()), parallel
+    ):
+        metrics.add_time("render", render_time)
+        metrics.add_time("write", write_time)
+        _record_stubs(results, redirect_record, metrics, manifest)
+
+    ok = metrics.counters["broken"] == broken
+    with metrics.phase("save_record"):
+        # stubs that were found broken in the outdir are checked again next time
+        redirect_record.digest = digest if ok else None
+        redirect_record.save()
+        _write_manifest(outdir, manifest)
+    return ok
+
+
+def _plan_digest(
+    graph: _RedirectGraph,
+    leaves: "array[int]",
+    template_hash: Union[str, None],
+    broken_sources: AbstractSet[str],
+) -> Union[str, None]:
+    """
+    Digest of the redirects of a resolved graph, the template and layout they are rendered
+    with (template_hash) and the redirects that are broken, or None if the template is
+    unknown. A build with the digest of the last build has nothing to write.
+    """
+    if template_hash is None:
+        return None
+    paths = graph.paths
+    digest = hashlib.blake2b(template_hash.encode("utf8"), digest_size=16)
+    digest.update(
+        "\n".join(
+            f"{paths[vertex]}\0{paths[leaves[vertex]]}" for vertex in graph.sources()
+        ).encode("utf8")
+    )
+    digest.update("\0\0".join(sorted(broken_sources)).encode("utf8"))
+    return digest.hexdigest()
+
+
+def _record_stubs(
+    results: List[_StubResult],
+    redirect_record: _RedirectRecord,
+    metrics: _Metrics,
+    manifest: _Manifest,
+) -> None:
+    """Log, count, record and add to the manifest the outcome of rendering each stub."""
+    for pending, outcome, stub_hash in results:
+        if outcome == "broken":
+            logger.warning(
+                f'{yellow("(broken)")} {pending.redirect_from} redirects to {pending.redirect_to} but {pending.build_redirect_from} already exists!'
+            )
+            metrics.count("broken")
+            continue
+        if outcome != "skipped":
+            logger.info(
+                f'{green("(good)")} {pending.redirect_from} {green("-->")} {pending.redirect_to}'
+            )
+            manifest["created" if outcome == "written" else "rewritten"].append(
+                {"path": pending.redirect_from.as_posix(), "hash": stub_hash}
+            )
+        metrics.count(outcome)
+        redirect_record.add(
+            pending.src_redirect_from.as_posix(),
+            pending.src_redirect_to.as_posix(),
+            stub_hash,
+        )
+
+
+def _remove_stale_stubs(
+    redirect_record: _RedirectRecord,
+    sources: Set[str],
+    stub_urls: Set[str],
+    outdir: Path,
+    outdir_index: _DirIndex,
+    source_suffix: List[str],
+    dirhtml: bool,
+    metrics: _Metrics,
+    manifest: _Manifest,
+) -> None:
+    """
+    Remove the stubs of recorded redirects that are no longer in sources. A stub is only
+    removed while the file still has the content that was written, so documents and files
+    that took its place are kept. Either way the redirect is dropped from the record.
+    """
+    for source in [source for source in redirect_record if source not in sources]:
+        stub_hash = redirect_record.written_hash(source)
+        redirect_record.remove(source)
+        redirect_from = _redirect_url(
+            Path(PureWindowsPath(source)), source_suffix, dirhtml
+        )
+        if (
+            stub_hash is None
+            or redirect_from.as_posix() in stub_urls
+            or not outdir_index.exists(redirect_from)
+        ):
+            continue
+        try:
+            if _stub_hash((outdir / redirect_from).read_bytes()) != stub_hash:
+                continue
+            outdir_index.unlink(redirect_from)
+        except OSError:
+            continue
+        logger.info(f'{green("(removed)")} {redirect_from}')
+        metrics.count("removed")
+        manifest["removed"].append(
+            {"path": redirect_from.as_posix(), "hash": stub_hash}
+        )
+
+
+def _check_redirects_in_outdir(
+    graph: _RedirectGraph,
+    leaves: "array[int]",
+    outdir: Path,
+    outdir_index: _DirIndex,
+    source_suffix: List[str],
+    dirhtml: bool,
+    redirect_record: _RedirectRecord,
+    broken_sources: Set[str],
+    metrics: _Metrics,
+) -> Tuple[Dict[Path, List[_PendingRedirect]], Set[str], Set[str]]:
+    """
+    Check every redirect against the outdir. Returns the stubs to render, grouped by output
+    directory so each worker touches one directory, and the source and stub url of every
+    redirect.
+
+    A stub in the record with the same destination and a known hash was rendered from the
+    same redirect and template, so it is up to date and skipped without rendering it. A
+    redirect whose stub another redirect already writes is reported as broken.
+    """
+    batches: Dict[Path, List[_PendingRedirect]] = {}
+    sources: Set[str] = set()
+    stub_urls: Set[str] = set()
+    for vertex in graph.sources():
+        # Normalize path - src_redirect_.* is relative so drive letters aren't an issue.
+        src_redirect_from = Path(PureWindowsPath(graph.paths[vertex]))
+        src_redirect_to = Path(PureWindowsPath(graph.paths[leaves[vertex]]))
+        source = src_redirect_from.as_posix()
+        sources.add(source)
+        if source in broken_sources:
+            # already reported
+            continue
+
+        redirect_from, redirect_to = _redirect_urls(
+            src_redirect_from, src_redirect_to, source_suffix, dirhtml
+        )
+        stub_urls.add(redirect_from.as_posix())
+
+        # absolute paths into the build dir
+        build_redirect_from = outdir / redirect_from
+        build_redirect_to = outdir / redirect_to
+
+        exists = outdir_index.exists(redirect_from)
+        if not outdir_index.claim(redirect_from):
+            # an earlier redirect writes this stub
+            logger.warning(
+                f'{yellow("(broken)")} {redirect_from} redirects to {redirect_to} but {build_redirect_from} already exists!'
+            )
+            metrics.count("broken")
+            continue
+        entry = redirect_record.lookup(source)
+        recorded = entry is not None
+        previous_hash = None if entry is None else entry[1]
+        if (
+            exists
+            and previous_hash is not None
+            and entry[0] == src_redirect_to.as_posix()
+        ):
+            metrics.count("skipped")
+            continue
+
+        if not outdir_index.exists(redirect_to):
+            if exists and not recorded:
+                logger.warning(
+                    f'{yellow("(broken)")} {redirect_from} redirects to {redirect_to} but {build_redirect_from} already exists!'
+                )
+            else:
+                logger.warning(
+                    f'{yellow("(broken)")} {redirect_from} redirects to {redirect_to} but {build_redirect_to} does not exist!'
+                )
+            metrics.count("broken")
+            continue
+
+        # existing files are rendered and compared: files that are not in the record are
+        # adopted if they are identical, stubs in the record rewritten if they changed
+        batches.setdefault(build_redirect_from.parent, []).append(
+            _PendingRedirect(
+                src_redirect_from,
+                src_redirect_to,
+                redirect_from,
+                redirect_to,
+                build_redirect_from,
+                build_redirect_to,
+                exists,
+                exists and recorded,
+                previous_hash,
+            )
+        )
+    return batches, sources, stub_urls
+
+
+@_profiled
+def build_redirects(app: Sphinx, exception: Union[Exception, None]) -> None:
+    """
+    Build amd write redirects
+    """
+    state = _build_state.pop(app, None)
+    metrics = _Metrics() if state is None else state[2]
+    early = None if state is None else state[3]
+
+    if exception != None:
+        if early is not None:
+            # keep track of the stubs that were written before the build failed
+            with _RedirectRecord.load(app.outdir) as redirect_record:
+                manifest = _new_manifest()
+                if _finish_early_redirects(early, redirect_record, metrics, manifest):
+                    with metrics.phase("save_record"):
+                        redirect_record.save()
+                        _write_manifest(app.outdir, manifest)
+        return
+
+    if _is_linkcheck(app.builder):
+        logger.info("rediraffe: Redirect generation skipped for linkcheck builders.")
+        return
+
+    if not _supports_redirects(app.builder):
+        logger.info(
+            "rediraffe: Redirect generation skipped for unsupported builders. Supported builders: html, dirhtml, readthedocs, readthedocsdirhtml."
+        )
+        return
+
+    with metrics.phase("load_record"):
+        redirect_record = _RedirectRecord.load(app.outdir)
+    with redirect_record:
+        # stubs already written while the html builder was writing
+        manifest = _new_manifest()
+        early_sources: Set[str] = set()
+        if early is not None:
+            early_sources = _finish_early_redirects(
+                early, redirect_record, metrics, manifest
+            )
+
+        with metrics.phase("load_template"):
+            rediraffe_template = app.config.rediraffe_template
+            if isinstance(rediraffe_template, str):
+                # path
+                template_path = Path(app.srcdir) / rediraffe_template
+                if template_path.exists():
+                    rediraffe_template = _load_template(
+                        template_path, Path(app.doctreedir) / TEMPLATE_CACHE_NAME
+                    )
+                else:
+                    logger.warning(
+                        "rediraffe: rediraffe_template does not exist. The default will be used."
+                    )
+                    rediraffe_template = _default_template()
+            else:
+                rediraffe_template = _default_template()
+
+        if state is not None:
+            # already loaded and checked right after reading
+            resolved, broken_sources = state[:2]
+        else:
+            resolved = _resolve_redirects(app, redirect_record, metrics)
+            broken_sources = set()
+        if resolved is None:
+            return
+        graph, leaves = resolved
+
+        logger.info("Writing redirects...")
+
+        if not _write_redirects(
+            rediraffe_template,
+            graph,
+            leaves,
+            Path(app.outdir),
+            list(app.config.source_suffix),
+            _is_dirhtml(app.builder),
+            redirect_record,
+            broken_sources,
+            app.parallel,
+            metrics,
+            manifest,
+            early_sources,
+        ):
+            app.statuscode = 1
+    metrics.report(app.outdir, app.builder.name, app.config.rediraffe_metrics)
+
+
+def _finish_early_redirects(
+    early: _EarlyRedirects,
+    redirect_record: _RedirectRecord,
+    metrics: _Metrics,
+    manifest: _Manifest,
+) -> Set[str]:
+    """Wait for the stubs written early and record them. Returns their sources."""
+    early_sources: Set[str] = set()
+    redirect_record.use_template(early.template_hash)
+    for results, render_time, write_time in early.finish():
+        metrics.add_time("render", render_time)
+        metrics.add_time("write", write_time)
+        _record_stubs(results, redirect_record, metrics, manifest)
+        early_sources.update(
+            pending.src_redirect_from.as_posix() for pending, _, _ in results
+        )
+    return early_sources
+
+
+def _iter_nul_fields(stream: Any, chunk_size: int = 1 << 16) -> Iterator[bytes]:
+    """Split a binary stream on NUL bytes, reading it in chunks."""
+    pending = b""
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        fields = (pending + chunk).split(b"\0")
+        pending = fields.pop()
+        yield from fields
+    if pending:
+        yield pending
+
+
+def _iter_git_diff(
+    srcdir: Path, branch: str, suffixes: Tuple[str, ...] = ()
+) -> Iterator[Tuple[str, str, Union[str, None], int]]:
+    """
+    Stream the files changed in the work tree of srcdir since branch from a single
+    `git diff -z --name-status -M`. Yields (status letter, path, renamed to, similarity),
+    with posix paths relative to srcdir. Only renames and copies have a destination and a
+    similarity. NUL separated output keeps paths with spaces or newlines intact.
+
+    The diff, and so rename detection, is limited by pathspec to srcdir and, if given, to
+    files ending in one of suffixes, which keeps it fast in large repositories.
+    """
+    import subprocess
+
+    args = ["git", "-C", str(srcdir), "diff", "-z", "--name-status", "-M", "--relative"]
+    # without a branch, diff the work tree against the index
+    branch = branch.strip()
+    if branch:
+        args.append(branch)
+    args.append("--")
+    args += [f":(glob)**/*{suffix}" for suffix in suffixes] or ["."]
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    with process:
+        fields = _iter_nul_fields(process.stdout)
+        for status in fields:
+            letter = status[:1].decode("ascii")
+            path = os.fsdecode(next(fields))
+            if letter in ("R", "C"):
+                yield letter, path, os.fsdecode(next(fields)), int(status[1:] or 100)
+            else:
+                yield letter, path, None, 0
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+def _git_diff_key(
+    srcdir: Path, branch: str, suffixes: Tuple[str, ...] = ()
+) -> Union[str, None]:
+    """
+    Key the changes since branch by the commit branch resolves to and the tree of srcdir
+    at HEAD. Returns None when the diff cannot be cached: without a branch, outside a git
+    repository, or when the work tree or index of srcdir has uncommitted changes.
+    """
+    import subprocess
+
+    branch = branch.strip()
+    if not branch:
+        return None
+    pathspecs = [f":(glob)**/*{suffix}" for suffix in suffixes] or ["."]
+    try:
+        # HEAD:./ is the tree of the current directory, i.e. srcdir, at HEAD
+        shas = subprocess.run(
+            ["git", "-C", str(srcdir), "rev-parse", f"{branch}^{{commit}}", "HEAD:./"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        ).stdout
+        status = subprocess.run(
+            ["git", "-C", str(srcdir), "status", "--porcelain", "-z"]
+            + ["--untracked-files=no", "--"]
+            + pathspecs,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if status:
+        return None
+    digest = hashlib.sha256(f"{DIFF_CACHE_VERSION}\0".encode("utf8"))
+    digest.update(shas)
+    digest.update("\0".join(pathspecs).encode("utf8"))
+    return digest.hexdigest()
+
+
+def _iter_cached_git_diff(
+    srcdir: Path, branch: str, suffixes: Tuple[str, ...], cache_path: Path
+) -> Iterator[Tuple[str, str, Union[str, None], int]]:
+    """
+    Like _iter_git_diff, but only yields deletions and renames, and replays them from
+    cache_path when neither branch nor the committed sources have changed since they were
+    last computed. Cached changes skip git rename detection entirely.
+    """
+    key = _git_diff_key(srcdir, branch, suffixes)
+    if key is not None:
+        try:
+            with cache_path.open("rb") as f:
+                cached = pickle.load(f)
+            if cached["key"] == key:
+                yield from cached["changes"]
+                return
+        except Exception:
+            # missing, stale or unreadable caches are rebuilt
+            pass
+
+    changes = []
+    for change in _iter_git_diff(srcdir, branch, suffixes):
+        if change[0] in ("D", "R"):
+            changes.append(change)
+            yield change
+
+    if key is not None:
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+            with tmp_path.open("wb") as f:
+                pickle.dump(
+                    {"key": key, "changes": changes}, f, pickle.HIGHEST_PROTOCOL
+                )
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning(f"rediraffe: could not write the diff cache: {e}")
+
+
+class _GitBlobReader:
+    """
+    Reads blobs from the repository of a directory through a single persistent
+    `git cat-file --batch` process, instead of starting git once per file.
+    """
+
+    def __init__(self, cwd: Path) -> None:
+        import subprocess
+
+        self.process = subprocess.Popen(
+            ["git", "-C", str(cwd), "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def read(self, spec: str) -> Union[bytes, None]:
+        """Returns the contents of the blob named by spec, or None if it is not a blob."""
+        if "\n" in spec:
+            # cat-file reads one object name per line
+            return None
+        self.process.stdin.write(os.fsencode(spec) + b"\n")
+        self.process.stdin.flush()
+        header = self.process.stdout.readline().split()
+        if len(header) != 3 or header[-1] in (b"missing", b"ambiguous"):
+            return None
+        _, kind, size = header
+        data = self.process.stdout.read(int(size))
+        self.process.stdout.read(1)
+        return data if kind == b"blob" else None
+
+    def close(self) -> None:
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process.wait()
+
+    def __enter__(self) -> "_GitBlobReader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class _SimilarityIndex:
+    """
+    Finds similar files by the Jaccard similarity of their word shingles.
+
+    Each file gets a MinHash signature from one permutation hashing: a single hash of every
+    shingle picks a bin and the smallest value is kept per bin, with empty bins filled
+    from the next non-empty bin. The fraction of bins two signatures agree on estimates
+    their similarity. Signatures are split into bands for locality sensitive hashing, so a
+    query only compares with files that share a whole band.
+    """
+
+    BINS = 128
+    BAND_ROWS = 2
+    SHINGLE_WORDS = 5
+
+    # words are matched in the raw bytes, treating any non-ascii byte as part of a word
+    RE_WORD = re.compile(rb"[\w\x80-\xff]+")
+
+    def __init__(self) -> None:
+        self.signatures: Dict[str, Tuple[int, ...]] = {}
+        self.buckets: Dict[Tuple[int, Tuple[int, ...]], List[str]] = {}
+
+    @classmethod
+    def signature(cls, text: bytes) -> Union[Tuple[int, ...], None]:
+        import zlib
+        from bisect import bisect
+
+        words = cls.RE_WORD.findall(text.lower())
+        if not words:
+            return None
+        # hashing tuples of word checksums is deterministic, unlike hashing strings
+        word_hashes = list(map(zlib.crc32, words))
+        width = min(cls.SHINGLE_WORDS, len(word_hashes))
+        shingles = zip(*(word_hashes[i:] for i in range(width)))
+        # keeping the last value per bin from a descending sort keeps the smallest
+        hashes = sorted(map(hash, shingles), reverse=True)
+        bins = cls.BINS
+        mins = dict(zip(map((bins - 1).__and__, hashes), hashes))
+
+        # densify: empty bins borrow from the next non-empty bin, offset by the distance
+        signature = [mins.get(b) for b in range(bins)]
+        if len(mins) < bins:
+            filled = sorted(mins)
+            for b in range(bins):
+                if signature[b] is None:
+                    source = filled[bisect(filled, b) % len(filled)]
+                    signature[b] = mins[source] + (((source - b) % bins) << 64)
+        return tuple(signature)
+
+    def _bands(
+        self, signature: Tuple[int, ...]
+    ) -> Iterator[Tuple[int, Tuple[int, ...]]]:
+        rows = self.BAND_ROWS
+        for band in range(0, self.BINS, rows):
+            yield band, signature[band : band + rows]
+
+    def add(self, name: str, signature: Tuple[int, ...]) -> None:
+        self.signatures[name] = signature
+        for band in self._bands(signature):
+            self.buckets.setdefault(band, []).append(name)
+
+    def query(
+        self, signature: Tuple[int, ...], limit: int = 3
+    ) -> List[Tuple[str, int]]:
+        """Returns up to limit (name, similarity percentage) pairs, most similar first."""
+        candidates = set()
+        for band in self._bands(signature):
+            candidates.update(self.buckets.get(band, ()))
+        scored = []
+        for name in candidates:
+            agree = sum(a == b for a, b in zip(signature, self.signatures[name]))
+            perc = round(100 * agree / self.BINS)
+            if perc:
+                scored.append((-perc, name))
+        return [(name, -neg_perc) for neg_perc, name in sorted(scored)[:limit]]
+
+
+def _file_signature(path: Path) -> Union[Tuple[int, ...], None]:
+    try:
+        return _SimilarityIndex.signature(path.read_bytes())
+    except OSError:
+        return None
+
+
+def _similar_files(
+    srcdir: Path, branch: str, deleted: List[str], candidates: List[str]
+) -> Dict[str, List[Tuple[str, int]]]:
+    """
+    Suggest redirects for files deleted since branch that git did not pair with a rename.
+    Each deleted file, read from branch through one `git cat-file --batch` process, is
+    compared with the candidate files in srcdir, returning the most similar candidates and
+    their similarity percentage by deleted file. Paths are posix and relative to srcdir.
+    """
+    suggestions: Dict[str, List[Tuple[str, int]]] = {}
+    if not deleted:
+        return suggestions
+
+    paths = [srcdir / candidate for candidate in candidates]
+    if len(paths) < 256 or (os.cpu_count() or 1) == 1:
+        signatures = list(map(_file_signature, paths))
+    else:
+        # multiprocessing is only imported when there are many files to compare with
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            signatures = list(pool.map(_file_signature, paths, chunksize=64))
+    index = _SimilarityIndex()
+    for candidate, signature in zip(candidates, signatures):
+        if signature is not None:
+            index.add(candidate, signature)
+
+    # without a branch, deleted files are still in the index
+    revision = branch.strip()
+    try:
+        with _GitBlobReader(srcdir) as reader:
+            for deleted_file in deleted:
+                text = reader.read(f"{revision}:./{deleted_file}")
+                signature = None if text is None else index.signature(text)
+                if signature is not None:
+                    suggestions[deleted_file] = index.query(signature)
+    except OSError as e:
+        logger.warning(f"rediraffe: could not read deleted files from git: {e}")
+    return suggestions
+
+
+def setup(app: Sphinx) -> Dict[str, Any]:
+    app.add_config_value("rediraffe_redirects", None, None)
+    app.add_config_value("rediraffe_branch", "", None)
+    app.add_config_value("rediraffe_template", None, None)
+    app.add_config_value("rediraffe_auto_redirect_perc", 100, None)
+    app.add_config_value("rediraffe_plan_layout", "html", None)
+    app.add_config_value("rediraffe_compact_drop_existing", False, None)
+    app.add_config_value("rediraffe_metrics", None, None)
+    app.add_config_value("rediraffe_profile", False, None)
+    app.add_config_value("rediraffe_early_write", False, None)
+
+    # the builders import sphinx.builders, so they are only imported once registered
+    from sphinxext import rediraffe_builders
+
+    for builder in (
+        rediraffe_builders.CheckRedirectsDiffBuilder,
+        rediraffe_builders.WriteRedirectsDiffBuilder,
+        rediraffe_builders.RedirectsPlanBuilder,
+        rediraffe_builders.RedirectsCompactBuilder,
+    ):
+        app.add_builder(builder)
+    app.connect("env-updated", check_redirects)
+    app.connect("html-page-context", write_early_redirects)
+    app.connect("build-finished", build_redirects)
+
+    return {
         "parallel_read_safe": True,
         "parallel_write_safe": True,
     }
+
+
+def main(argv: Union[List[str], None] = None) -> int:
+    """
+    Write redirect stubs into an already built outdir without running Sphinx.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="python -m sphinxext.rediraffe",
+        description="Write rediraffe redirect stubs into an already built html or dirhtml outdir.",
+    )
+    parser.add_argument(
+        "redirects", nargs="+", type=Path, help="rediraffe redirects file(s)"
+    )
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        required=True,
+        type=Path,
+        help="the built html output directory",
+    )
+    parser.add_argument(
+        "-b",
+        "--layout",
+        choices=("html", "dirhtml"),
+        default="html",
+        help="the layout of the outdir (default: html)",
+    )
+    parser.add_argument(
+        "-s",
+        "--source-suffix",
+        action="append",
+        dest="source_suffix",
+        help="a source file suffix, may be given several times (default: .rst)",
+    )
+    parser.add_argument("-t", "--template", type=Path, help="a jinja template")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of threads writing stubs (default: 1)",
+    )
+    parser.add_argument(
+        "--metrics",
+        choices=tuple(METRICS_NAMES),
+        help="also write phase timings and counters to the outdir in this format",
+    )
+    args = parser.parse_args(argv)
+
+    # report through the logger of this module, without a Sphinx application
+    handler = StreamHandler(sys.stdout)
+    logger.logger.addHandler(handler)
+    logger.logger.setLevel(INFO)
+    logger.logger.propagate = False
+    if not color_terminal():
+        nocolor()
+
+    for path in args.redirects:
+        if not path.is_file():
+            logger.error(red(f"rediraffe: redirects file {path} does not exist."))
+            return 1
+    if not args.outdir.is_dir():
+        logger.error(red(f"rediraffe: outdir {args.outdir} does not exist."))
+        return 1
+
+    metrics = _Metrics()
+    try:
+        with metrics.phase("parse"):
+            graph = _create_redirect_graph(*args.redirects)
+            graph.split_patterns()
+        with metrics.phase("resolve"):
+            leaves = graph.resolve()
+    except ExtensionError:
+        # already reported
+        return 1
+    if graph.patterns:
+        logger.error(
+            red(
+                "rediraffe: prefix redirects need the source tree and are only supported in Sphinx builds."
+            )
+        )
+        return 1
+
+    with metrics.phase("load_template"):
+        if args.template is None:
+            template = _default_template()
+        elif args.template.is_file():
+            template = _load_template(args.template)
+        else:
+            logger.error(red(f"rediraffe: template {args.template} does not exist."))
+            return 1
+
+    with metrics.phase("load_record"):
+        redirect_record = _RedirectRecord.load(args.outdir)
+
+    logger.info("Writing redirects...")
+    with redirect_record:
+        ok = _write_redirects(
+            template,
+            graph,
+            leaves,
+            args.outdir,
+            args.source_suffix or [".rst"],
+            args.layout == "dirhtml",
+            redirect_record,
+            set(),
+            args.jobs,
+            metrics,
+        )
+    metrics.report(args.outdir, args.layout, args.metrics)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,394 @@
+from __future__ import annotations
+
+import json
+import os
+import posixpath
+import time
+from contextlib import nullcontext
+from pathlib import Path, PurePath
+from typing import Any, Dict, List, Set, Tuple, Union
+
+from sphinx.builders import Builder
+from sphinx.errors import ExtensionError
+from sphinx.util import logging
+from sphinx.util.console import green, red  # pylint: disable=no-name-in-module
+
+from sphinxext.rediraffe import (
+    DIFF_CACHE_NAME,
+    REDIRECT_PLAN_NAME,
+    _compact_redirects,
+    _iter_cached_git_diff,
+    _Metrics,
+    _parse_redirects,
+    _plan_redirects,
+    _PrefixTrie,
+    _profiling,
+    _RedirectRecord,
+    _redirect_files,
+    _rel_url,
+    _resolve_redirects,
+    _similar_files,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class _NoWriteBuilder(Builder):
+    """
+    A builder that does all of its work in init and neither reads nor writes documents.
+    """
+
+    def get_outdated_docs(self) -> List[str]:
+        return []
+
+    def prepare_writing(self, docnames: Set[str]) -> None:
+        pass
+
+    def write_doc(self, docname: str, doctree: Any) -> None:
+        pass
+
+    def get_target_uri(self, docname: str, typ: Union[str, None] = None) -> str:
+        return ""
+
+    def read(self) -> List[str]:
+        return []
+
+
+class CheckRedirectsDiffBuilder(_NoWriteBuilder):
+    name = "rediraffecheckdiff"
+
+    def init(self) -> None:
+        super().init()
+
+        metrics = _Metrics(("parse", "diff", "validate", "similarity"))
+        profiling = (
+            _profiling(Path(self.app.doctreedir), self.name)
+            if self.app.config.rediraffe_profile
+            else nullcontext()
+        )
+        try:
+            with profiling:
+                self._check_diff(metrics)
+        finally:
+            metrics.report(self.outdir, self.name, self.app.config.rediraffe_metrics)
+
+    def _check_diff(self, metrics: _Metrics) -> None:
+        """
+        Check that files deleted or renamed since rediraffe_branch are redirected, and
+        for rediraffewritediff add renamed files to the redirects file.
+        """
+        source_suffixes = set(self.app.config.source_suffix)
+        src_path = Path(self.app.srcdir)
+
+        start = time.perf_counter()
+        rediraffe_redirects = self.app.config.rediraffe_redirects
+        redirects_path = None
+        if isinstance(rediraffe_redirects, dict):
+            pass
+        elif isinstance(rediraffe_redirects, (str, list, tuple)):
+            redirects_paths = _redirect_files(src_path, rediraffe_redirects)
+            if redirects_paths is None:
+                self.app.statuscode = 1
+                return
+            if isinstance(rediraffe_redirects, str):
+                redirects_path = redirects_paths[0]
+            try:
+                rediraffe_redirects = _parse_redirects(*redirects_paths, root=src_path)
+            except ExtensionError as e:
+                self.app.statuscode = 1
+                return
+        else:
+            logger.error("rediraffe: rediraffe was not given redirects to process.")
+            self.app.statuscode = 1
+            return
+
+        metrics.add_time("parse", time.perf_counter() - start)
+
+        # redirect sources as normalized posix paths relative to the source directory
+        redirects_by_path = {
+            posixpath.normpath(redirect_from.replace("\\", "/")): redirect_to
+            for redirect_from, redirect_to in rediraffe_redirects.items()
+        }
+
+        # prefix redirects (old/* new/*) redirect every file below their source prefix
+        redirect_prefixes = _PrefixTrie()
+        for redirect_from, redirect_to in rediraffe_redirects.items():
+            if redirect_from.endswith("*") and redirect_to.endswith("*"):
+                redirect_prefixes.insert(
+                    redirect_from[:-1].replace("\\", "/"),
+                    redirect_to[:-1].replace("\\", "/"),
+                )
+
+        def redirected_to(rel_path: str) -> Union[str, None]:
+            if rel_path in redirects_by_path:
+                return redirects_by_path[rel_path]
+            match = redirect_prefixes.longest_match(rel_path)
+            if match is None:
+                return None
+            prefix_from, prefix_to = match
+            return prefix_to + rel_path[len(prefix_from) :]
+
+        suffixes = tuple(source_suffixes)
+
+        def is_source_file(rel_path: str) -> bool:
+            # git already limits the diff to the source directory and suffixes
+            return not rel_path.startswith("../") and rel_path.endswith(suffixes)
+
+        def check_deleted(deleted_file: str) -> None:
+            deleted_file_to = redirected_to(deleted_file)
+            if deleted_file_to is not None:
+                logger.info(
+                    f"deleted file {src_path / deleted_file} redirects to {src_path / deleted_file_to}."
+                )
+                metrics.count("skipped")
+                return
+            # deletions git did not pair with a rename are compared by content later
+            unpaired.append(deleted_file)
+
+        def check_unpaired(deleted_file: str, hints: List[Tuple[str, int]]) -> None:
+            if hints and auto_redirect(deleted_file, *hints[0], kind="Deleted"):
+                return
+            err_msg = f'{red("(broken)")} {src_path / deleted_file} was deleted but is not redirected!'
+            if hints:
+                similar = ", ".join(
+                    f"{src_path / hint_to} ({perc}%)" for hint_to, perc in hints
+                )
+                err_msg += f" Hint: This file is similar to {similar}."
+            logger.error(err_msg)
+            metrics.count("broken")
+            self.app.statuscode = 1
+
+        def auto_redirect(
+            redirect_from: str, redirect_to: str, perc: int, kind: str
+        ) -> bool:
+            if self.name != "rediraffewritediff":
+                return False
+            if perc < self.app.config.rediraffe_auto_redirect_perc:
+                return False
+            rel_redirect_from = f'"{redirect_from}"'
+            rel_redirect_to = f'"{redirect_to}"'
+            redirects_file.write(f"{rel_redirect_from} {rel_redirect_to}\n")
+            logger.info(
+                f"{green('(okay)')} {kind} file {rel_redirect_from} has been redirected to {rel_redirect_to} in your redirects file!"
+            )
+            metrics.count("written")
+            return True
+
+        def check_renamed(renamed_file: str, hint_to: str, perc: int) -> None:
+            renamed_file_to = redirected_to(renamed_file)
+            if renamed_file_to is not None:
+                logger.info(
+                    f"renamed file {src_path / renamed_file} redirects to {src_path / renamed_file_to}."
+                )
+                metrics.count("skipped")
+                return
+
+            if auto_redirect(renamed_file, hint_to, perc, kind="Renamed"):
+                return
+
+            err_msg = (
+                f"{red('(broken)')} {src_path / renamed_file} was deleted but is not redirected!"
+                f" Hint: This file was renamed to {src_path / hint_to} with a similarity of {perc}%."
+            )
+            logger.error(err_msg)
+            metrics.count("broken")
+            self.app.statuscode = 1
+
+        # only the auto redirect builder appends to the redirects file
+        if self.name == "rediraffewritediff":
+            redirects_file = redirects_path.open("a")
+        else:
+            redirects_file = nullcontext()
+        unpaired: List[str] = []
+        start = time.perf_counter()
+        validate_time = 0.0
+        with redirects_file:
+            # deletions and renames are checked as git reports them
+            for status, changed_file, renamed_to, perc in _iter_cached_git_diff(
+                src_path,
+                self.app.config.rediraffe_branch,
+                suffixes,
+                Path(self.app.doctreedir) / DIFF_CACHE_NAME,
+            ):
+                if not is_source_file(changed_file):
+                    continue
+                check_start = time.perf_counter()
+                if status == "D":
+                    check_deleted(changed_file)
+                elif is_source_file(renamed_to):
+                    check_renamed(changed_file, renamed_to, perc)
+                validate_time += time.perf_counter() - check_start
+            metrics.add_time("validate", validate_time)
+            metrics.add_time("diff", time.perf_counter() - start - validate_time)
+
+            with metrics.phase("similarity"):
+                hints = self._similar_files(src_path, unpaired)
+                for deleted_file in unpaired:
+                    check_unpaired(deleted_file, hints.get(deleted_file, []))
+
+    def _similar_files(
+        self, src_path: Path, deleted: List[str]
+    ) -> Dict[str, List[Tuple[str, int]]]:
+        if not deleted:
+            return {}
+        self.env.find_files(self.config, self)
+        candidates = sorted(
+            PurePath(self.env.doc2path(docname, False)).as_posix()
+            for docname in self.env.found_docs
+        )
+        return _similar_files(
+            src_path, self.app.config.rediraffe_branch, deleted, candidates
+        )
+
+
+class WriteRedirectsDiffBuilder(CheckRedirectsDiffBuilder):
+    name = "rediraffewritediff"
+
+    def init(self) -> None:
+        rediraffe_redirects = self.app.config.rediraffe_redirects
+        if not isinstance(rediraffe_redirects, str):
+            logger.error(
+                f"{red('(broken)')} Automatic redirects is only available with a single redirects file."
+            )
+            self.app.statuscode = 1
+            return
+
+        super().init()
+
+
+class RedirectsPlanBuilder(_NoWriteBuilder):
+    """
+    Compute every redirect stub the html or dirhtml builder would write, without reading or
+    writing any documents, and write the plan as json to the outdir.
+    """
+
+    name = "rediraffeplan"
+
+    def init(self) -> None:
+        super().init()
+
+        layout = self.app.config.rediraffe_plan_layout
+        if layout not in ("html", "dirhtml"):
+            logger.error(
+                red(
+                    f"rediraffe: rediraffe_plan_layout must be html or dirhtml, not {layout}."
+                )
+            )
+            self.app.statuscode = 1
+            return
+
+        # find the documents without reading them
+        self.env.find_files(self.config, self)
+
+        try:
+            resolved = _resolve_redirects(self.app, _RedirectRecord(), _Metrics())
+        except ExtensionError:
+            return
+        if resolved is None:
+            self.app.statuscode = 1
+            return
+        graph, leaves = resolved
+
+        plan = []
+        broken = 0
+        for (
+            src_from,
+            src_to,
+            redirect_from,
+            redirect_to,
+            problem,
+        ) in _plan_redirects(
+            self.app, graph, leaves, self.env.found_docs, layout == "dirhtml"
+        ):
+            plan.append(
+                {
+                    "from_file": src_from.as_posix(),
+                    "to_file": src_to.as_posix(),
+                    "from_url": redirect_from.as_posix(),
+                    "to_url": redirect_to.as_posix(),
+                    "rel_url": _rel_url(redirect_from, redirect_to),
+                    "broken": None
+                    if problem is None
+                    else f"{problem[0].as_posix()} {problem[1]}",
+                }
+            )
+            if problem is None:
+                logger.info(
+                    f'{green("(good)")} {redirect_from} {green("-->")} {redirect_to}'
+                )
+            else:
+                logger.error(
+                    f'{red("(broken)")} {redirect_from} redirects to {redirect_to} but {problem[0]} {problem[1]}'
+                )
+                broken += 1
+                self.app.statuscode = 1
+
+        plan_path = Path(self.outdir) / REDIRECT_PLAN_NAME
+        plan_path.parent.mkdir(parents=True, exist_ok=True)
+        plan_path.write_text(
+            json.dumps(
+                {"layout": layout, "broken": broken, "redirects": plan}, indent=1
+            ),
+            encoding="utf8",
+        )
+        logger.info(
+            f"rediraffe: {len(plan)} redirects ({broken} broken) planned in {plan_path}."
+        )
+
+
+class RedirectsCompactBuilder(_NoWriteBuilder):
+    """
+    Rewrite the redirects file in canonical form, see _compact_redirects.
+    """
+
+    name = "rediraffecompact"
+
+    def init(self) -> None:
+        super().init()
+
+        rediraffe_redirects = self.app.config.rediraffe_redirects
+        if not isinstance(rediraffe_redirects, str):
+            logger.error(
+                f"{red('(broken)')} Compacting redirects is only available with a single redirects file."
+            )
+            self.app.statuscode = 1
+            return
+        redirects_paths = _redirect_files(Path(self.app.srcdir), rediraffe_redirects)
+        if redirects_paths is None:
+            self.app.statuscode = 1
+            return
+        redirects_path = redirects_paths[0]
+
+        existing = None
+        if self.app.config.rediraffe_compact_drop_existing:
+            # find the documents without reading them
+            self.env.find_files(self.config, self)
+            existing = {
+                PurePath(self.env.doc2path(docname, False)).as_posix()
+                for docname in self.env.found_docs
+            }
+
+        try:
+            compacted = _compact_redirects(redirects_path, existing)
+        except ExtensionError:
+            self.app.statuscode = 1
+            return
+
+        with open(redirects_path, "r") as file:
+            if file.read() == compacted.text:
+                logger.info(f"rediraffe: {rediraffe_redirects} is already compact.")
+                return
+
+        import shutil
+
+        # write to a temporary file first so the redirects file is never left partial
+        tmp_path = redirects_path.with_name(f"{redirects_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as file:
+            file.write(compacted.text)
+        shutil.copymode(redirects_path, tmp_path)
+        os.replace(tmp_path, redirects_path)
+        logger.info(
+            f"rediraffe: compacted {rediraffe_redirects} to {compacted.entries} redirects. "
+            f"{compacted.collapsed} chains collapsed, {compacted.duplicates} duplicates and "
+            f"{compacted.dropped} redirects from existing documents dropped."
+        )
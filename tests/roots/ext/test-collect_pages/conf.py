@@ -0,0 +1,19 @@
+extensions = ["sphinxext.rediraffe"]
+
+master_doc = "index"
+exclude_patterns = ["_build"]
+
+html_theme = "basic"
+
+rediraffe_redirects = {
+    "old.rst": "extra.rst",
+    "gone.rst": "missing.rst",
+}
+
+
+def collect_pages(app):
+    yield "extra", {"title": "Extra", "body": "<p>Extra</p>"}, "page.html"
+
+
+def setup(app):
+    app.connect("html-collect-pages", collect_pages)
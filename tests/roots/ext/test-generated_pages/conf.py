@@ -0,0 +1,14 @@
+extensions = ["sphinxext.rediraffe"]
+
+master_doc = "index"
+exclude_patterns = ["_build"]
+
+html_theme = "basic"
+templates_path = ["_templates"]
+html_additional_pages = {"special": "special.html"}
+
+rediraffe_redirects = {
+    "a.rst": "genindex.rst",
+    "b.rst": "special.rst",
+    "c.rst": "search.rst",
+}
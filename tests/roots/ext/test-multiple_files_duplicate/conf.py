@@ -0,0 +1,8 @@
+extensions = ["sphinxext.rediraffe"]
+
+master_doc = "index"
+exclude_patterns = ["_build"]
+
+html_theme = "basic"
+
+rediraffe_redirects = ["redirects/*.txt", "more_redirects.txt"]
@@ -0,0 +1,9 @@
+extensions = ["sphinxext.rediraffe"]
+
+master_doc = "index"
+exclude_patterns = ["_build"]
+source_suffix = {".rst": "restructuredtext", ".txt": "restructuredtext"}
+
+html_theme = "basic"
+
+rediraffe_redirects = "redirects.txt"
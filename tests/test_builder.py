@@ -1,3 +1,6 @@
+import json
+from pathlib import Path
+
 import pytest
 from sphinx.testing.path import path
 
@@ -83,3 +86,58 @@ def test_builder_deleted_file_redirected_commit(app_init_repo):
 def test_builder_deleted_file_not_redirected_commit(app_init_repo):
     app_init_repo.build()
     assert app_init_repo.statuscode == 1
+
+
+@pytest.mark.sphinx(
+    "rediraffecheckdiff",
+    testroot="deleted_file_not_redirected",
+    confoverrides={"rediraffe_metrics": "json"},
+)
+def test_builder_metrics(app_init_repo):
+    app_init_repo.build()
+    assert app_init_repo.statuscode == 1
+    metrics = json.loads(
+        (Path(app_init_repo.outdir) / "rediraffe_metrics.json").read_text("utf8")
+    )
+    assert metrics["builder"] == "rediraffecheckdiff"
+    assert metrics["counters"]["broken"] == 1
+    assert set(metrics["phases"]) == {"parse", "diff", "validate", "similarity"}
+
+
+@pytest.mark.sphinx(
+    "rediraffecheckdiff",
+    testroot="deleted_file_redirected",
+    confoverrides={"rediraffe_profile": True},
+)
+def test_builder_profile(app_init_repo):
+    app_init_repo.build()
+    assert app_init_repo.statuscode == 0
+    doctreedir = Path(app_init_repo.doctreedir)
+    assert (doctreedir / "rediraffe_rediraffecheckdiff.prof").is_file()
+    assert (doctreedir / "rediraffe_rediraffecheckdiff.tracemalloc").is_file()
+
+
+@pytest.mark.sphinx("rediraffecheckdiff", testroot="deleted_file_not_redirected_commit")
+def test_builder_diff_cache(app_init_repo, make_app, app_params, monkeypatch):
+    app_init_repo.build()
+    assert app_init_repo.statuscode == 1
+    assert (Path(app_init_repo.doctreedir) / "rediraffe_diff.pickle").is_file()
+
+    def iter_git_diff(*args):
+        raise AssertionError("the cached diff was not used")
+
+    monkeypatch.setattr("sphinxext.rediraffe._iter_git_diff", iter_git_diff)
+    args, kwargs = app_params
+    app = make_app(*args, **kwargs)
+    app.build()
+    assert app.statuscode == 1
+
+
+@pytest.mark.sphinx("rediraffecheckdiff", testroot="deleted_file_similar")
+def test_builder_deleted_file_similar(app_init_repo):
+    app_init_repo.build()
+    assert app_init_repo.statuscode == 1
+    warnings = app_init_repo._warning.getvalue()
+    assert "another.rst was deleted but is not redirected!" in warnings
+    assert "Hint: This file is similar to" in warnings
+    assert "rewritten.rst (100%)" in warnings
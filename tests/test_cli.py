@@ -0,0 +1,78 @@
+import sqlite3
+import subprocess
+import sys
+from contextlib import closing
+from pathlib import Path
+
+
+def run_cli(*args, cwd):
+    return subprocess.run(
+        [sys.executable, "-m", "sphinxext.rediraffe", *map(str, args)],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        env={"PYTHONPATH": str(Path(__file__).parent.parent)},
+    )
+
+
+def make_outdir(tmp_path: Path, *files: str) -> Path:
+    outdir = tmp_path / "out"
+    for file in files:
+        (outdir / file).parent.mkdir(parents=True, exist_ok=True)
+        (outdir / file).write_text("<html></html>")
+    return outdir
+
+
+def test_cli_html(tmp_path: Path):
+    outdir = make_outdir(tmp_path, "index.html", "sub/b.html")
+    (tmp_path / "redirects.txt").write_text("a.rst sub/b.rst\nsub/c.md index.rst\n")
+    result = run_cli(
+        "redirects.txt", "-o", outdir, "-s", ".rst", "-s", ".md", cwd=tmp_path
+    )
+    assert result.returncode == 0, result.stdout
+    assert "sub/b.html" in (outdir / "a.html").read_text()
+    assert "../index.html" in (outdir / "sub" / "c.html").read_text()
+    with closing(sqlite3.connect(outdir / "_rediraffe_redirected.sqlite")) as record:
+        assert record.execute("PRAGMA user_version").fetchone()[0] == 3
+        assert dict(record.execute("SELECT source, target FROM redirects")) == {
+            "a.rst": "sub/b.rst",
+            "sub/c.md": "index.rst",
+        }
+
+
+def test_cli_dirhtml_template(tmp_path: Path):
+    outdir = make_outdir(tmp_path, "index.html", "b/index.html")
+    (tmp_path / "redirects.txt").write_text("a.rst b.rst\n")
+    (tmp_path / "template.html").write_text("{{ rel_url }} {{ from_file }}")
+    result = run_cli(
+        "redirects.txt",
+        "-o",
+        outdir,
+        "-b",
+        "dirhtml",
+        "-t",
+        "template.html",
+        cwd=tmp_path,
+    )
+    assert result.returncode == 0, result.stdout
+    assert (outdir / "a" / "index.html").read_text() == "../b/index.html a.rst"
+
+
+def test_cli_broken(tmp_path: Path):
+    outdir = make_outdir(tmp_path, "index.html")
+    (tmp_path / "redirects.txt").write_text("a.rst b.rst\n")
+    result = run_cli("redirects.txt", "-o", outdir, cwd=tmp_path)
+    assert result.returncode == 1
+    assert "does not exist!" in result.stdout
+    assert not (outdir / "a.html").exists()
+
+
+def test_cli_stub_collision(tmp_path: Path):
+    outdir = make_outdir(tmp_path, "index.html", "other.html")
+    (tmp_path / "redirects.txt").write_text("a.rst index.rst\na.md other.rst\n")
+    result = run_cli(
+        "redirects.txt", "-o", outdir, "-s", ".rst", "-s", ".md", cwd=tmp_path
+    )
+    assert result.returncode == 1
+    assert "already exists!" in result.stdout
+    assert "index.html" in (outdir / "a.html").read_text()
@@ -0,0 +1,63 @@
+from pathlib import Path
+
+import pytest
+from sphinx.application import Sphinx
+from sphinx.testing.path import path
+
+
+@pytest.fixture(scope="module")
+def rootdir():
+    return path(__file__).parent.abspath() / "roots" / "ext"
+
+
+def read_redirects(app: Sphinx, name: str = "redirects.txt") -> str:
+    return (Path(app.srcdir) / name).read_text()
+
+
+@pytest.mark.sphinx("rediraffecompact", testroot="compact", srcdir="compact")
+def test_compact(app: Sphinx):
+    app.build()
+    assert app.statuscode == 0
+    assert read_redirects(app) == (
+        "# Redirects for the docs\n"
+        "# keep sorted\n"
+        "\n"
+        '"a b.rst" real.rst\n'
+        "exists.rst real.rst\n"
+        "# moved\n"
+        "m.rst old/q.rst\n"
+        "old/* new/*\n"
+        "x.rst real.rst\n"
+        "y.rst real.rst\n"
+        "# old api\n"
+        "z.rst real.rst\n"
+        "# trailing\n"
+    )
+    assert "3 chains collapsed, 1 duplicates" in app._status.getvalue()
+
+
+@pytest.mark.sphinx(
+    "rediraffecompact",
+    testroot="compact",
+    srcdir="compact_drop_existing",
+    confoverrides={"rediraffe_compact_drop_existing": True},
+)
+def test_compact_drop_existing(app: Sphinx):
+    app.build()
+    assert app.statuscode == 0
+    redirects = read_redirects(app)
+    assert "exists.rst" not in redirects
+    assert "x.rst real.rst\n" in redirects
+
+
+@pytest.mark.sphinx(
+    "rediraffecompact",
+    testroot="compact",
+    srcdir="compact_conflict",
+    confoverrides={"rediraffe_redirects": "conflict.txt"},
+)
+def test_compact_conflict(app: Sphinx):
+    before = read_redirects(app, "conflict.txt")
+    app.build()
+    assert app.statuscode == 1
+    assert read_redirects(app, "conflict.txt") == before
@@ -200,3 +200,33 @@ class TestCreateGraphQuotes:
             "\"quoteskept'": "other",
             "\"I'm ready! I'm ready!\" - Spongebob Squarepants.rst": "just why?.rst",
         }
+
+
+def test_create_graph_tabs(tmp_path):
+    path = tmp_path / "rediraffe.txt"
+    path.write_text("a\tb\nc \t d\n")
+    graph = create_graph(path)
+    assert graph == {
+        "a": "b",
+        "c": "d",
+    }
+
+
+def test_create_graph_too_many_paths(tmp_path):
+    path = tmp_path / "rediraffe.txt"
+    path.write_text(
+        """
+        a b
+        c d e
+        """
+    )
+    with pytest.raises(ExtensionError):
+        graph = create_graph(path)
+
+
+def test_create_graph_duplicate_line_number(tmp_path, caplog):
+    path = tmp_path / "rediraffe.txt"
+    path.write_text("a b\n# comment\nc d\na e\n")
+    with pytest.raises(ExtensionError):
+        graph = create_graph(path)
+    assert "(line 4, first redirected at line 1)" in caplog.text
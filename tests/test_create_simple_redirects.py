@@ -97,3 +97,54 @@ def test_create_simple_redirects_mixed_chains():
         "h": "i",
     }
     assert create_simple_redirects(redirects) == simple_redirects
+
+
+def test_create_simple_redirects_deep_chain():
+    depth = 100_000
+    redirects = {str(i): str(i + 1) for i in range(depth)}
+
+    simple_redirects = create_simple_redirects(redirects)
+    assert len(simple_redirects) == depth
+    assert all(leaf == str(depth) for leaf in simple_redirects.values())
+
+
+def test_create_simple_redirects_chain_into_chain():
+    redirects = {
+        "x": "b",
+        "a": "b",
+        "b": "c",
+        "c": "d",
+        "y": "a",
+    }
+
+    simple_redirects = {
+        "x": "d",
+        "a": "d",
+        "b": "d",
+        "c": "d",
+        "y": "d",
+    }
+    assert create_simple_redirects(redirects) == simple_redirects
+
+
+def test_create_simple_redirects_cycle_reported_once(caplog):
+    redirects = {
+        "a": "b",
+        "b": "c",
+        "c": "a",
+        "d": "a",
+        "e": "d",
+        "f": "f",
+    }
+
+    with pytest.raises(ExtensionError) as excinfo:
+        create_simple_redirects(redirects)
+
+    cycle_errors = [
+        record
+        for record in caplog.records
+        if "A circular redirect exists" in record.getMessage()
+    ]
+    assert len(cycle_errors) == 2
+    for vertex in redirects:
+        assert vertex in str(excinfo.value)
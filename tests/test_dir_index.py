@@ -0,0 +1,40 @@
+from pathlib import Path
+
+from sphinxext.rediraffe import _DirIndex
+
+
+def test_dir_index_walk(tmp_path):
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "a" / "b" / "c.html").write_text("")
+    (tmp_path / "index.html").write_text("")
+
+    index = _DirIndex(tmp_path)
+    assert index.exists("index.html")
+    assert index.exists(Path("a") / "b" / "c.html")
+    assert index.exists("a/b")
+    assert not index.exists("a/c.html")
+
+
+def test_dir_index_makedirs(tmp_path):
+    index = _DirIndex(tmp_path)
+    index.makedirs(Path("x") / "y" / "z")
+    assert (tmp_path / "x" / "y" / "z").is_dir()
+    assert index.exists("x")
+    assert index.exists("x/y/z")
+
+    # already known directories are not created again
+    (tmp_path / "x" / "y" / "z").rmdir()
+    index.makedirs("x/y/z")
+    assert not (tmp_path / "x" / "y" / "z").exists()
+
+
+def test_dir_index_files(tmp_path):
+    (tmp_path / "old.html").write_text("")
+    index = _DirIndex(tmp_path)
+    index.unlink("old.html")
+    assert not index.exists("old.html")
+    assert not (tmp_path / "old.html").exists()
+
+    assert index.claim("new.html")
+    assert index.exists("./new.html")
+    assert not index.claim("./new.html")
@@ -3,12 +3,25 @@ import seleniumbase
 from seleniumbase import BaseCase
 from sphinx.testing.path import path
 from sphinx.application import Sphinx
-from sphinx.errors import ExtensionError
+from sphinx.errors import ExtensionError, SphinxWarning
 from pathlib import Path
+import os
 import shutil
 import logging
+import json
+import pstats
+import sqlite3
+import tracemalloc
+from contextlib import closing
 
 from conftest import rel2url
+from sphinxext import rediraffe
+
+
+def load_record(outdir, columns="target"):
+    """The destination (or other columns) of every redirect in the record of outdir."""
+    with closing(sqlite3.connect(Path(outdir) / "_rediraffe_redirected.sqlite")) as db:
+        return dict(db.execute(f"SELECT source, {columns} FROM redirects"))
 
 
 @pytest.fixture(scope="module")
@@ -22,6 +35,12 @@ class TestExtHtml:
         app.build()
         assert app.statuscode == 0
 
+    @pytest.mark.sphinx("text", testroot="simple")
+    def test_unsupported_builder(self, app: Sphinx):
+        app.build()
+        assert app.statuscode == 0
+        assert not (Path(app.outdir) / "_rediraffe_redirected.sqlite").exists()
+
     @pytest.mark.sphinx("html", testroot="simple")
     def test_simple(self, app: Sphinx, ensure_redirect):
         app.build()
@@ -106,6 +125,17 @@ class TestExtHtml:
         app.build()
         assert app.statuscode == 1
 
+    @pytest.mark.sphinx(
+        "html", testroot="link_redirected_to_nonexistant_file", warningiserror=True
+    )
+    def test_broken_redirect_fails_before_writing(self, app_params, make_app):
+        args, kwargs = app_params
+        app = make_app(*args, **kwargs)
+        shutil.rmtree(Path(app.outdir))
+        with pytest.raises(SphinxWarning, match="does not exist"):
+            app.build()
+        assert not (Path(app.outdir) / "index.html").exists()
+
     @pytest.mark.sphinx("html", testroot="bad_rediraffe_file")
     def test_bad_rediraffe_file(self, app: Sphinx):
         app.build()
@@ -125,6 +155,43 @@ class TestExtHtml:
         ensure_redirect("deletedfolder/another.html", "index.html")
         ensure_redirect("deletedfolder/deletedfolder2/another.html", "index.html")
 
+    @pytest.mark.sphinx("html", testroot="generated_pages")
+    def test_generated_pages(self, app: Sphinx):
+        app.build()
+        assert app.statuscode == 0
+        assert "does not exist" not in app._warning.getvalue()
+        outdir = Path(app.outdir)
+        assert "genindex.html" in (outdir / "a.html").read_text()
+        assert "special.html" in (outdir / "b.html").read_text()
+        assert "search.html" in (outdir / "c.html").read_text()
+
+    @pytest.mark.sphinx("html", testroot="collect_pages")
+    def test_collect_pages(self, app: Sphinx):
+        app.build()
+        # the missing destination is still reported, once, after the build
+        assert app.statuscode == 1
+        warnings = app._warning.getvalue()
+        assert "extra.html does not exist" not in warnings
+        assert warnings.count("missing.html does not exist!") == 1
+        outdir = Path(app.outdir)
+        assert "extra.html" in (outdir / "old.html").read_text()
+        assert not (outdir / "gone.html").exists()
+
+    @pytest.mark.sphinx("html", testroot="stub_collision")
+    def test_stub_collision(self, app: Sphinx):
+        app.build()
+        assert app.statuscode == 1
+        warnings = app._warning.getvalue()
+        assert warnings.count("already exists!") == 1
+        assert "a.html redirects to other.html" in warnings
+        assert "index.html" in (Path(app.outdir) / "a.html").read_text()
+
+    @pytest.mark.sphinx("dirhtml", testroot="stub_collision")
+    def test_stub_collision_dirhtml(self, app: Sphinx):
+        app.build()
+        assert app.statuscode == 1
+        assert app._warning.getvalue().count("already exists!") == 2
+
     @pytest.mark.sphinx("html", testroot="complex")
     def test_complex(self, app: Sphinx, ensure_redirect):
         app.build()
@@ -160,6 +227,221 @@ class TestExtHtml:
 
         ensure_redirect("F5/F4/F3/F2/F1/1.html", "index.html")
 
+    @pytest.mark.sphinx("html", testroot="complex", parallel=4)
+    def test_complex_parallel(self, app: Sphinx):
+        app.build()
+        assert app.statuscode == 0
+
+        outdir = Path(app.outdir)
+        record = load_record(outdir)
+        assert record["a.rst"] == "e.rst"
+        assert record["F1/1.rst"] == "z.rst"
+        assert record["F5/F4/F3/F2/F1/1.rst"] == "index.rst"
+        assert len(record) == 25
+        for name in record:
+            assert (outdir / name).with_suffix(".html").is_file()
+
+    @pytest.mark.sphinx("html", testroot="complex")
+    def test_resolved_cache(self, app_params, make_app, monkeypatch):
+        args, kwargs = app_params
+        app = make_app(*args, **kwargs)
+        app.build()
+        assert app.statuscode == 0
+        assert (Path(app.doctreedir) / "rediraffe_resolved.pickle").is_file()
+
+        def fail(*paths, root=None):
+            raise AssertionError("redirects were parsed again")
+
+        monkeypatch.setattr(rediraffe, "_create_redirect_graph", fail)
+        shutil.rmtree(Path(app.outdir))
+        app2 = make_app(*args, **kwargs)
+        app2.build()
+        assert app2.statuscode == 0
+        record = load_record(app2.outdir)
+        assert record["a.rst"] == "e.rst"
+
+    @pytest.mark.sphinx(
+        "html", testroot="complex", confoverrides={"rediraffe_metrics": "json"}
+    )
+    def test_metrics(self, app_params, make_app):
+        args, kwargs = app_params
+        app = make_app(*args, **kwargs)
+        if Path(app.outdir).exists():
+            shutil.rmtree(Path(app.outdir))
+        app.build()
+        assert app.statuscode == 0
+        metrics = json.loads(
+            (Path(app.outdir) / "rediraffe_metrics.json").read_text("utf8")
+        )
+        assert metrics["builder"] == "html"
+        assert metrics["counters"] == {
+            "written": 25,
+            "skipped": 0,
+            "rewritten": 0,
+            "removed": 0,
+            "broken": 0,
+        }
+        assert set(metrics["phases"]) >= {
+            "load_record",
+            "load_template",
+            "parse",
+            "resolve",
+            "validate",
+            "render",
+            "write",
+            "save_record",
+        }
+
+        app2 = make_app(*args, **kwargs)
+        app2.build()
+        metrics = json.loads(
+            (Path(app2.outdir) / "rediraffe_metrics.json").read_text("utf8")
+        )
+        assert metrics["counters"]["written"] == 0
+        assert metrics["counters"]["skipped"] == 25
+
+    @pytest.mark.sphinx(
+        "html",
+        testroot="link_redirected_to_nonexistant_file",
+        confoverrides={"rediraffe_metrics": "prometheus"},
+    )
+    def test_metrics_prometheus(self, app: Sphinx):
+        app.build()
+        assert app.statuscode == 1
+        metrics = (Path(app.outdir) / "rediraffe_metrics.prom").read_text("utf8")
+        assert "# TYPE rediraffe_phase_seconds gauge" in metrics
+        assert 'rediraffe_redirects{builder="html",outcome="broken"} 1' in metrics
+
+    @pytest.mark.sphinx(
+        "html", testroot="simple", confoverrides={"rediraffe_profile": True}
+    )
+    def test_profile(self, app: Sphinx):
+        app.build()
+        assert app.statuscode == 0
+        doctreedir = Path(app.doctreedir)
+        for name in ("check_redirects", "build_redirects"):
+            stats = pstats.Stats(str(doctreedir / f"rediraffe_{name}.prof"))
+            assert stats.total_calls > 0
+            tracemalloc.Snapshot.load(str(doctreedir / f"rediraffe_{name}.tracemalloc"))
+
+    @pytest.mark.sphinx(
+        "html",
+        testroot="complex",
+        srcdir="complex_early_write",
+        confoverrides={"rediraffe_early_write": True, "rediraffe_metrics": "json"},
+    )
+    def test_early_write(self, app_params, make_app):
+        args, kwargs = app_params
+        app = make_app(*args, **kwargs)
+        if Path(app.outdir).exists():
+            shutil.rmtree(Path(app.outdir))
+        submitted = []
+
+        def before_build_redirects(app, exception):
+            submitted.extend(rediraffe._build_state[app][3].futures)
+
+        app.connect("build-finished", before_build_redirects, priority=100)
+        app.build()
+        assert app.statuscode == 0
+        # every redirect of this project redirects to a document
+        assert submitted
+        metrics = json.loads(
+            (Path(app.outdir) / "rediraffe_metrics.json").read_text("utf8")
+        )
+        assert metrics["counters"]["written"] == 25
+        assert metrics["counters"]["broken"] == 0
+        record = load_record(app.outdir)
+        assert len(record) == 25
+
+        app2 = make_app(*args, **kwargs)
+        app2.build()
+        metrics = json.loads(
+            (Path(app2.outdir) / "rediraffe_metrics.json").read_text("utf8")
+        )
+        assert metrics["counters"]["written"] == 0
+        assert metrics["counters"]["skipped"] == 25
+
+    @pytest.mark.sphinx(
+        "html",
+        testroot="complex",
+        srcdir="complex_early_write_parallel",
+        parallel=4,
+        confoverrides={"rediraffe_early_write": True},
+    )
+    def test_early_write_parallel(self, app: Sphinx):
+        early = []
+
+        def before_build_redirects(app, exception):
+            early.append(rediraffe._build_state[app][3])
+
+        app.connect("build-finished", before_build_redirects, priority=100)
+        app.build()
+        assert app.statuscode == 0
+        assert early == [None]
+        assert "e.html" in (Path(app.outdir) / "a.html").read_text()
+
+    @pytest.mark.sphinx(
+        "html",
+        testroot="generated_pages",
+        srcdir="generated_pages_early_write",
+        confoverrides={
+            "rediraffe_early_write": True,
+            "rediraffe_redirects": {"search.rst": "index.rst", "d.rst": "index.rst"},
+        },
+    )
+    def test_early_write_generated_pages(self, app: Sphinx):
+        app.build()
+        assert app.statuscode == 1
+        assert "search.html already exists!" in app._warning.getvalue()
+        outdir = Path(app.outdir)
+        assert "searchindex.js" in (outdir / "search.html").read_text()
+        assert "index.html" in (outdir / "d.html").read_text()
+
+    @pytest.mark.sphinx("html", testroot="multiple_files")
+    def test_multiple_files(self, app: Sphinx):
+        app.build()
+        assert app.statuscode == 0
+
+        record = load_record(app.outdir)
+        assert record == {
+            "a.rst": "another.rst",
+            "b.rst": "another.rst",
+            "c.rst": "index.rst",
+        }
+
+    @pytest.mark.sphinx("html", testroot="multiple_files_duplicate")
+    def test_multiple_files_duplicate(self, app: Sphinx):
+        with pytest.raises(ExtensionError):
+            app.build()
+        assert app.statuscode == 1
+        assert (
+            "(more_redirects.txt:2, first redirected at redirects/1.txt:2)"
+            in app._warning.getvalue()
+        )
+
+    @pytest.mark.sphinx("html", testroot="prefix")
+    def test_prefix(self, app: Sphinx):
+        app.build()
+        assert app.statuscode == 0
+
+        record = load_record(app.outdir)
+        assert record == {
+            "legacy.rst": "new/api/a.rst",
+            "old/api/a.rst": "new/api/a.rst",
+            "old/api/sub/b.rst": "index.rst",
+        }
+
+    @pytest.mark.sphinx("html", testroot="prefix_merge")
+    def test_prefix_merge(self, app: Sphinx):
+        app.build()
+        assert app.statuscode == 0
+
+        record = load_record(app.outdir)
+        assert record == {
+            "old1/a.rst": "new/a.rst",
+            "old2/a.rst": "new/a.rst",
+        }
+
     @pytest.mark.sphinx("html", testroot="complex_dict")
     def test_complex_dict(self, app: Sphinx, ensure_redirect):
         app.build()
@@ -211,6 +493,185 @@ class TestExtHtml:
         assert "from_url: another.html" in text
         assert "to_url: index.html" in text
 
+    @pytest.mark.sphinx("html", testroot="jinja", srcdir="jinja_cache")
+    def test_jinja_cache(self, app: Sphinx):
+        app.build()
+        assert app.statuscode == 0
+        assert (
+            "from_file: another.rst" in (Path(app.outdir) / "another.html").read_text()
+        )
+
+        cache_dir = Path(app.doctreedir) / "rediraffe_templates"
+        assert list(cache_dir.glob("*.cache"))
+        template_path = Path(app.srcdir) / "rediraffe_template.html"
+        template = rediraffe._load_template(template_path, cache_dir)
+        assert rediraffe._load_template(template_path, cache_dir) is template
+
+        # modified templates are recompiled
+        template_path.write_text("modified {{ rel_url }}")
+        mtime = template_path.stat().st_mtime + 10
+        os.utime(template_path, (mtime, mtime))
+        modified = rediraffe._load_template(template_path, cache_dir)
+        assert modified.render(rel_url="index.html") == "modified index.html"
+
+    @pytest.mark.sphinx(
+        "html",
+        testroot="jinja",
+        srcdir="jinja_incremental",
+        confoverrides={"rediraffe_metrics": "json"},
+    )
+    def test_jinja_changed(self, app_params, make_app):
+        args, kwargs = app_params
+
+        def build():
+            app = make_app(*args, **kwargs)
+            app.build()
+            assert app.statuscode == 0
+            return json.loads(
+                (Path(app.outdir) / "rediraffe_metrics.json").read_text("utf8")
+            )["counters"]
+
+        def edit_template(text):
+            template_path = Path(app.srcdir) / "rediraffe_template.html"
+            template_path.write_text(text)
+            mtime = template_path.stat().st_mtime + 10
+            os.utime(template_path, (mtime, mtime))
+            return template_path.read_text()
+
+        app = make_app(*args, **kwargs)
+        shutil.rmtree(Path(app.outdir), ignore_errors=True)
+        assert build()["written"] == 1
+        stub = Path(app.outdir) / "another.html"
+        os.utime(stub, (1_000_000, 1_000_000))
+
+        # a template change that renders the same stubs leaves them untouched
+        template = (Path(app.srcdir) / "rediraffe_template.html").read_text()
+        edit_template("{# unchanged output #}" + template)
+        counters = build()
+        assert counters["skipped"] == 1
+        assert counters["rewritten"] == 0
+        assert stub.stat().st_mtime == 1_000_000
+
+        edit_template("changed {{ rel_url }}")
+        counters = build()
+        assert counters["rewritten"] == 1
+        assert stub.read_text() == "changed index.html"
+
+    @pytest.mark.sphinx(
+        "html",
+        testroot="complex",
+        srcdir="complex_adopt",
+        confoverrides={"rediraffe_metrics": "json"},
+    )
+    def test_record_adopt(self, app_params, make_app):
+        args, kwargs = app_params
+        app = make_app(*args, **kwargs)
+        shutil.rmtree(Path(app.outdir), ignore_errors=True)
+        app.build()
+        json_path = Path(app.outdir) / "_rediraffe_redirected.json"
+        db_path = Path(app.outdir) / "_rediraffe_redirected.sqlite"
+        record = load_record(app.outdir)
+        stubs = [Path(app.outdir) / Path(name).with_suffix(".html") for name in record]
+        for stub in stubs:
+            os.utime(stub, (1_000_000, 1_000_000))
+
+        # JSON records of older versions are migrated, identical stubs are left
+        # untouched, and stubs that are not in the record are adopted if they are identical
+        adopt_record = dict(list(record.items())[5:])
+        v2_record = {
+            "version": 2,
+            "template": None,
+            "redirects": {source: [target, None] for source, target in record.items()},
+        }
+        for legacy_record in (record, v2_record, adopt_record, None):
+            if legacy_record is None:
+                db_path.unlink()
+            else:
+                json_path.write_text(json.dumps(legacy_record))
+            app = make_app(*args, **kwargs)
+            app.build()
+            assert app.statuscode == 0
+            counters = json.loads(
+                (Path(app.outdir) / "rediraffe_metrics.json").read_text("utf8")
+            )["counters"]
+            assert counters == {
+                "written": 0,
+                "skipped": 25,
+                "rewritten": 0,
+                "removed": 0,
+                "broken": 0,
+            }
+            assert all(stub.stat().st_mtime == 1_000_000 for stub in stubs)
+            assert load_record(app.outdir) == record
+            assert not json_path.exists()
+            assert all(load_record(app.outdir, "hash IS NOT NULL AND fresh").values())
+
+    @pytest.mark.sphinx("html", testroot="complex", srcdir="complex_manifest")
+    def test_manifest(self, app_params, make_app):
+        args, kwargs = app_params
+        app = make_app(*args, **kwargs)
+        shutil.rmtree(Path(app.outdir), ignore_errors=True)
+        app.build()
+        assert app.statuscode == 0
+        manifest_path = Path(app.outdir) / "_rediraffe_manifest.json"
+        manifest = json.loads(manifest_path.read_text("utf8"))
+        assert len(manifest["created"]) == 25
+        assert manifest["rewritten"] == manifest["removed"] == []
+        created = {entry["path"]: entry["hash"] for entry in manifest["created"]}
+        assert created["k.html"] == rediraffe._stub_hash(
+            (Path(app.outdir) / "k.html").read_bytes()
+        )
+        record = load_record(app.outdir)
+
+        # stubs of dropped redirects are removed unless they were changed since
+        redirects_path = Path(app.srcdir) / "redirects.txt"
+        redirects = redirects_path.read_text()
+        redirects = redirects.replace("i.rst  j.rst\n", "").replace("k.rst l.rst\n", "")
+        redirects_path.write_text(redirects)
+        (Path(app.outdir) / "i.html").write_text("replaced")
+        app = make_app(*args, **kwargs)
+        app.build()
+        assert app.statuscode == 0
+        manifest = json.loads(manifest_path.read_text("utf8"))
+        assert manifest["created"] == manifest["rewritten"] == []
+        assert manifest["removed"] == [{"path": "k.html", "hash": created["k.html"]}]
+        assert not (Path(app.outdir) / "k.html").exists()
+        assert (Path(app.outdir) / "i.html").read_text() == "replaced"
+        assert set(load_record(app.outdir)) == set(record) - {"i.rst", "k.rst"}
+
+    @pytest.mark.sphinx(
+        "html",
+        testroot="complex",
+        srcdir="complex_noop",
+        confoverrides={"rediraffe_metrics": "json"},
+    )
+    def test_noop_build(self, app_params, make_app):
+        args, kwargs = app_params
+        app = make_app(*args, **kwargs)
+        shutil.rmtree(Path(app.outdir), ignore_errors=True)
+        app.build()
+        assert app.statuscode == 0
+
+        # the redirects did not change, so the outdir is not checked again
+        app = make_app(*args, **kwargs)
+        app.build()
+        assert app.statuscode == 0
+        assert "rediraffe: 25 redirects are up to date." in app._status.getvalue()
+        metrics = json.loads(
+            (Path(app.outdir) / "rediraffe_metrics.json").read_text("utf8")
+        )
+        assert metrics["counters"]["skipped"] == 25
+        assert metrics["phases"]["write"] == metrics["phases"]["render"] == 0
+
+        redirects_path = Path(app.srcdir) / "redirects.txt"
+        redirects_path.write_text(redirects_path.read_text() + "\nzz.rst z.rst\n")
+        app = make_app(*args, **kwargs)
+        app.build()
+        assert app.statuscode == 0
+        assert "redirects are up to date" not in app._status.getvalue()
+        assert (Path(app.outdir) / "zz.html").is_file()
+        assert len(load_record(app.outdir)) == 26
+
     @pytest.mark.sphinx("html", testroot="jinja_bad_path")
     def test_jinja_bad_path(self, app: Sphinx, ensure_redirect):
         app.build()
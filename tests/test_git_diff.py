@@ -0,0 +1,56 @@
+import io
+import subprocess
+from pathlib import Path
+
+from sphinxext.rediraffe import _iter_git_diff, _iter_nul_fields
+
+
+def test_nul_fields_across_chunks():
+    stream = io.BytesIO(b"R100\0old name.rst\0new\nname.rst\0D\0gone.rst\0")
+    assert list(_iter_nul_fields(stream, chunk_size=3)) == [
+        b"R100",
+        b"old name.rst",
+        b"new\nname.rst",
+        b"D",
+        b"gone.rst",
+    ]
+
+
+def test_nul_fields_unterminated():
+    assert list(_iter_nul_fields(io.BytesIO(b"a\0b"))) == [b"a", b"b"]
+    assert list(_iter_nul_fields(io.BytesIO(b""))) == []
+
+
+def git(repo: Path, *args: str):
+    subprocess.run(
+        ["git", "-c", "user.name=test", "-c", "user.email=NONE", "-C", str(repo)]
+        + list(args),
+        check=True,
+        capture_output=True,
+    )
+
+
+def test_git_diff_single_pass(tmp_path: Path):
+    git(tmp_path, "init")
+    content = "\n".join(f"line {i}" for i in range(20))
+    (tmp_path / "docs" / "sub").mkdir(parents=True)
+    (tmp_path / "docs" / "old page.rst").write_text(content)
+    (tmp_path / "docs" / "sub" / "deleted.rst").write_text("deleted")
+    (tmp_path / "docs" / "changed.rst").write_text("before")
+    (tmp_path / "docs" / "notes.txt").write_text("notes")
+    (tmp_path / "outside.rst").write_text("outside")
+    git(tmp_path, "add", "-A")
+    git(tmp_path, "commit", "-m", "first")
+
+    git(tmp_path, "mv", "docs/old page.rst", "docs/new page.rst")
+    git(tmp_path, "rm", "-q", "docs/sub/deleted.rst", "docs/notes.txt", "outside.rst")
+    (tmp_path / "docs" / "changed.rst").write_text("after")
+
+    # limited to the docs directory and to the source suffixes, relative to docs
+    changes = sorted(_iter_git_diff(tmp_path / "docs", "HEAD", (".rst",)))
+    assert changes == [
+        ("D", "sub/deleted.rst", None, 0),
+        ("M", "changed.rst", None, 0),
+        ("R", "old page.rst", "new page.rst", 100),
+    ]
+    assert ("D", "notes.txt", None, 0) in _iter_git_diff(tmp_path / "docs", "HEAD")
@@ -0,0 +1,71 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+# modules that importing the extension must not pull in
+DEFERRED_MODULES = [
+    "jinja2",
+    "subprocess",
+    "multiprocessing",
+    "sphinx.application",
+    "sphinx.builders",
+    "sphinx.builders.html",
+    "sphinx.builders.dirhtml",
+    "sphinx.builders.linkcheck",
+]
+
+
+def imported_modules(code: str):
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import json, sys\n{code}\nprint(json.dumps(sorted(sys.modules)))",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={"PYTHONPATH": str(Path(__file__).parent.parent)},
+    )
+    return set(json.loads(result.stdout.splitlines()[-1]))
+
+
+def test_import_is_lazy():
+    modules = imported_modules("import sphinxext.rediraffe")
+    assert "sphinxext.rediraffe" in modules
+    assert not modules.intersection(DEFERRED_MODULES)
+
+
+def test_lazy_attributes():
+    modules = imported_modules(
+        "from sphinxext import rediraffe\n"
+        "assert rediraffe.DEFAULT_REDIRAFFE_TEMPLATE.render(rel_url='x')\n"
+        "assert rediraffe.CheckRedirectsDiffBuilder.name == 'rediraffecheckdiff'\n"
+        "assert issubclass(rediraffe.WriteRedirectsDiffBuilder, rediraffe.CheckRedirectsDiffBuilder)\n"
+    )
+    assert "jinja2" in modules
+    assert "sphinx.builders" in modules
+    assert "sphinx.builders.linkcheck" not in modules
+
+
+def test_cli_does_not_import_sphinx(tmp_path: Path):
+    outdir = tmp_path / "out"
+    outdir.mkdir()
+    (outdir / "index.html").write_text("<html></html>")
+    (tmp_path / "redirects.txt").write_text("a.rst index.rst\n")
+    modules = imported_modules(
+        "import runpy\n"
+        f"sys.argv = ['rediraffe', {str(tmp_path / 'redirects.txt')!r}, '-o', {str(outdir)!r}]\n"
+        "try:\n"
+        "    runpy.run_module('sphinxext.rediraffe', run_name='__main__')\n"
+        "except SystemExit as e:\n"
+        "    assert e.code == 0, e.code\n"
+    )
+    assert "index.html" in (outdir / "a.html").read_text()
+    assert not {
+        module
+        for module in modules
+        if module in ("sphinx", "docutils")
+        or module.startswith(("sphinx.", "docutils."))
+    }
@@ -0,0 +1,73 @@
+import json
+from pathlib import Path
+
+import pytest
+from sphinx.application import Sphinx
+from sphinx.testing.path import path
+
+
+@pytest.fixture(scope="module")
+def rootdir():
+    return path(__file__).parent.abspath() / "roots" / "ext"
+
+
+def load_plan(app: Sphinx):
+    return json.loads((Path(app.outdir) / "rediraffe_plan.json").read_text("utf8"))
+
+
+@pytest.mark.sphinx("rediraffeplan", testroot="nested")
+def test_plan_html(app: Sphinx):
+    app.build()
+    assert app.statuscode == 0
+    plan = load_plan(app)
+    assert plan["layout"] == "html"
+    assert plan["broken"] == 0
+    by_from = {redirect["from_url"]: redirect for redirect in plan["redirects"]}
+    assert by_from
+    for redirect in by_from.values():
+        assert redirect["broken"] is None
+        assert redirect["from_url"].endswith(".html")
+    # nothing was read or written
+    assert not list(Path(app.outdir).glob("**/*.html"))
+
+
+@pytest.mark.sphinx(
+    "rediraffeplan",
+    testroot="simple",
+    confoverrides={"rediraffe_plan_layout": "dirhtml"},
+)
+def test_plan_dirhtml(app: Sphinx):
+    app.build()
+    assert app.statuscode == 0
+    assert load_plan(app)["redirects"] == [
+        {
+            "from_file": "another.rst",
+            "to_file": "index.rst",
+            "from_url": "another/index.html",
+            "to_url": "index.html",
+            "rel_url": "../index.html",
+            "broken": None,
+        }
+    ]
+
+
+@pytest.mark.sphinx("rediraffeplan", testroot="generated_pages")
+def test_plan_generated_pages(app: Sphinx):
+    app.build()
+    assert app.statuscode == 0
+    plan = load_plan(app)
+    assert plan["broken"] == 0
+    assert {redirect["to_url"] for redirect in plan["redirects"]} == {
+        "genindex.html",
+        "special.html",
+        "search.html",
+    }
+
+
+@pytest.mark.sphinx("rediraffeplan", testroot="link_redirected_to_nonexistant_file")
+def test_plan_broken(app: Sphinx):
+    app.build()
+    assert app.statuscode == 1
+    plan = load_plan(app)
+    assert plan["broken"] == 1
+    assert plan["redirects"][0]["broken"].endswith("does not exist!")
@@ -0,0 +1,20 @@
+from sphinxext.rediraffe import _PrefixTrie
+
+
+def test_prefix_trie_longest_match():
+    trie = _PrefixTrie()
+    trie.insert("old/", "a")
+    trie.insert("old/api/", "b")
+
+    assert trie.longest_match("old/api/x.rst") == ("old/api/", "b")
+    assert trie.longest_match("old/apix.rst") == ("old/", "a")
+    assert trie.longest_match("old/") == ("old/", "a")
+    assert trie.longest_match("new/api/x.rst") is None
+
+
+def test_prefix_trie_empty_prefix():
+    trie = _PrefixTrie()
+    assert trie.longest_match("x.rst") is None
+
+    trie.insert("", "root")
+    assert trie.longest_match("x.rst") == ("", "root")
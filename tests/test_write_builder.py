@@ -29,3 +29,12 @@ def test_builder_renamed_file_write_perc_low_pass(app_init_repo):
     valid_string = '"another.rst" "another2.rst"'
     with open(path(app_init_repo.srcdir).joinpath("redirects.txt"), "r") as file:
         assert valid_string in file.readline()
+
+
+@pytest.mark.sphinx("rediraffewritediff", testroot="deleted_write_file_similar")
+def test_builder_deleted_file_write_similar(app_init_repo):
+    app_init_repo.build()
+    assert app_init_repo.statuscode == 0
+    valid_string = '"another.rst" "rewritten.rst"'
+    with open(path(app_init_repo.srcdir).joinpath("redirects.txt"), "r") as file:
+        assert valid_string in file.readline()